@@ -8,13 +8,16 @@ import logging
 import os
 
 from modules.network.network import Network
-from modules.network.message import Message
+from modules.network.message import Message, MessageFormatError, text
+from modules.network.framereader import FrameReader
+from modules.network.asyncengine import AsyncEngine
 from modules.network.entity import Entity
 import modules.dfs.dfs as dfs # DFS exceptions
 from modules.dfs.dfs import DFS # DFS itself
 import modules.dfs.dfsmanager as DFSM
 
 from modules.dfs.filewriter import Filewriter # writes files
+from modules.flusher.flusher import FlushError
 
 from modules.logger.log import Log
 
@@ -28,6 +31,9 @@ my_id = None
 
 network = None
 
+# set by --async: run networking on one asyncio event loop instead of threads
+engine = None
+
 manager = None
 
 filewriter = None
@@ -53,6 +59,12 @@ def connect_to_network():
 
 def exit():
     print("Exiting DooFuS.")
+    # os._exit skips the flusher threads, so write out what they hold first
+    for state in (manager, network):
+        try:
+            state.flush()
+        except FlushError as e:
+            print(e)
     os._exit(0)
 
 ####################################
@@ -61,7 +73,7 @@ def exit():
 def send_heartbeats():
     while True:
         time.sleep(5)
-        network.broadcast_heartbeats()
+        network.broadcast_heartbeats(filewriter.free_space())
 
 #####################################
 ## Incoming Network Communication
@@ -69,92 +81,144 @@ def send_heartbeats():
 def listen_for_messages(conn, host):
     logger.info("Listening to " + str(host))
 
-    start_time = time.time()
-    verified = False
+    reader = FrameReader(conn)
+    state = {}
     time_to_die = False
-    while True:
-        # end thread and connection if one of messages failed is no longer connected (and once was)
-        if time_to_die:
-            print("Node %s no longer alive. Disconnecting" % (host))
-            network.disconnect_from_host(host)
-            conn.close()
-            return
-
-        # determine the type of message
-        type = bytes.decode(conn.recv(1))
-        if type:
-            # try to determine the size of the message
-            size =  bytes.decode(conn.recv(Message.LENGTH_SIZE))
-            if size:
-                # recieve the rest of the message (the actual data)
-                size = int(size)
-                msg = bytes.decode(conn.recv(size))
-
-
-        verified = verified or network.verified(host)
-        well_formatted = type and msg
-        
-        # handle the actual message
-        if not verified:
-                # don't handle any messages from unverified hosts except verify
-            if type == Message.Tags.IDENTITY:
-                time_to_die = not handle_verify_msg(msg, host)
-                
-            if not time_to_die:
-                # kill connection if not verified within 2 seconds
-                time_to_die =  time.time() - start_time > 2
-        else:
-            # TODO get rid of unnecessary nesting
-            if not network.connected(host):
-                # this is where we will see when the connection should die mostly
-                time_to_die = True
-            elif well_formatted:
-                # got an actual message
-                logger.debug("got message %s:%d:%s" % (type,size,msg))
-
-                if type == Message.Tags.HEARTBEAT:
-                    logger.debug("Received heartbeat from %s" % (host))
-                    network.record_heartbeat(host)
-                elif type == Message.Tags.HOST_JOINED:
-                    handle_host_msg(msg, host)
-                elif type == Message.Tags.USER_INFO:
-                    handle_users_msg(msg)
-                elif type == Message.Tags.DFS_INFO:
-                    handle_dfs_info_message(msg)
-                elif type == Message.Tags.STORE_REPLICA:
-                    handle_store_replica(msg, host)
-                elif type == Message.Tags.REQUEST_FILE:
-                    handle_request_file(msg, host)
-                elif type == Message.Tags.FILE_SLICE:
-                    handle_file_slice(msg)
-                elif type == Message.Tags.HAVE_REPLICA:
-                    handle_have_replica(msg, host)
-                elif type == Message.Tags.POKE:
-                    print("%s poked you!" % network.id(host))
-                elif type == Message.Tags.UPLOAD_FILE:
-                    handle_upload(msg, host)
-                elif type == Message.Tags.REMOVE_FILE:
-                    handle_remove_file(msg, host)
+    while not time_to_die:
+        # read one whole frame
+        try:
+            frame = reader.next_frame()
+        except (OSError, MessageFormatError) as e:
+            logger.info("Bad frame from %s: %s" % (host, e))
+            frame = None
+
+        time_to_die = handle_frame(frame, host, state)
+
+    # end thread and connection if one of messages failed is no longer connected (and once was)
+    close_connection(host)
+    conn.close()
+
+# Handles one frame from host (None once the connection is gone). state is
+# private to the connection. Returns True when the connection should die.
+# Shared by the threaded and the asyncio engines.
+def handle_frame(frame, host, state):
+    if frame is None:
+        return True
+
+    if "start_time" not in state:
+        state["start_time"] = time.time()
+        state["verified"] = False
+
+    type, msg = frame
+    state["verified"] = state["verified"] or network.verified(host)
+
+    # handle the actual message
+    if not state["verified"]:
+        # don't handle any messages from unverified hosts except verify
+        if type == Message.Tags.IDENTITY:
+            codecs = text(msg[1]).split(",") if len(msg) > 1 and len(msg[1]) else []
+            if not handle_verify_msg(text(msg[0]), host, codecs):
+                return True
+            return False
+
+        # A data connection carries no IDENTITY of its own and can deliver a
+        # bulk frame before the control connection's IDENTITY is handled.
+        # Hold the frame for the 2 seconds any connection gets to verify
+        if not wait_for_verification(host, state["start_time"] + 2):
+            logger.error("Dropping %s frame from %s: not verified within 2 seconds" % (type, host))
+            return True
+        state["verified"] = True
+
+    if not network.connected(host):
+        # this is where we will see when the connection should die mostly
+        return True
+
+    # got an actual message
+    logger.debug("got message %s:%d" % (type, sum(len(field) for field in msg)))
+
+    if type == Message.Tags.HEARTBEAT:
+        logger.debug("Received heartbeat from %s" % (host))
+        free_space = text(msg[0])
+        network.record_heartbeat(host, int(free_space) if free_space.isdigit() else None)
+    elif type == Message.Tags.HOST_JOINED:
+        handle_host_msg(text(msg[0]), host)
+    elif type == Message.Tags.USER_INFO:
+        handle_users_msg(msg)
+    elif type == Message.Tags.DFS_INFO:
+        handle_dfs_info_message(text(msg[0]))
+    elif type == Message.Tags.DFS_DIGEST:
+        handle_dfs_digest_message(text(msg[0]), host)
+    elif type == Message.Tags.STORE_REPLICA:
+        handle_store_replica(msg, host)
+    elif type == Message.Tags.REQUEST_FILE:
+        handle_request_file(msg, host)
+    elif type == Message.Tags.FILE_SLICE:
+        handle_file_slice(msg, host)
+    elif type == Message.Tags.HAVE_REPLICA:
+        handle_have_replica(msg, host)
+    elif type == Message.Tags.MANIFEST:
+        handle_manifest(msg, host)
+    elif type == Message.Tags.NEED_PARTS:
+        handle_need_parts(msg, host)
+    elif type == Message.Tags.POKE:
+        print("%s poked you!" % network.id(host))
+    elif type == Message.Tags.UPLOAD_FILE:
+        handle_upload(msg, host)
+    elif type == Message.Tags.REMOVE_FILE:
+        handle_remove_file(text(msg[0]), host)
+    return False
+
+# True once host is verified, False if it still isn't by deadline
+def wait_for_verification(host, deadline):
+    while not network.verified(host):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def close_connection(host):
+    print("Node %s no longer alive. Disconnecting" % (host))
+    network.disconnect_from_host(host)
 
 def handle_request_file(msg, host):
-    msg = msg.split(Message.DELIMITER)
-    file_name = msg[0]
-    part_num = msg[1]
-    total_parts = msg[2]
+    file_name = text(msg[0])
+    part_num = text(msg[1])
+    total_parts = text(msg[2])
     logger.info("Request for part %s/%s of %s from %s" % (part_num, total_parts, file_name, host))
-    
+
+    if not filewriter.has_part(file_name, part_num):
+        logger.info("Don't have part %s of %s" % (part_num, file_name))
+        return
+
+    total_parts = str(filewriter.get_total(file_name))
+
+    # parts differ in size, so the requester is told where each one goes
+    position = filewriter.part_position(file_name, part_num)
+    if not position:
+        logger.info("Don't have all of %s to place part %s" % (file_name, part_num))
+        return
+    file_offset, file_size = position
+    coding = filewriter.coding(file_name)
+
+    # parts stored as raw bytes on disk go out with sendfile, no copies
+    where = filewriter.replica_range(file_name, part_num)
+    if where:
+        path, offset, length = where
+        network.serve_file_range(host, file_name, part_num, total_parts, file_offset, file_size,
+                                 path, offset, length, coding)
+        return
+
     # read file data from replica
     data = filewriter.read_from_replica(file_name, part_num)
     
     # send to requester
-    network.serve_file_request(host, file_name, part_num, total_parts, data)
+    network.serve_file_request(host, file_name, part_num, total_parts, file_offset, file_size, data, coding)
 
 def handle_store_replica(msg, host):
-    msg = msg.split(Message.DELIMITER)
-    file_name = msg[0]
-    uploader = msg[1]
-    part_num = msg[2]
-    total_parts = msg[3]
+    file_name = text(msg[0])
+    uploader = text(msg[1])
+    part_num = text(msg[2])
+    total_parts = text(msg[3])
     data = msg[4]
     logger.info("Receiving " + uploader + "'s file " + file_name + " from " + host + "...")
 
@@ -167,38 +231,78 @@ def handle_store_replica(msg, host):
     logger.info("Finished alerting other nodes in network")
 
 def handle_have_replica(msg, host):
-    msg = msg.split(Message.DELIMITER)
-    file_name = msg[0]
-    uploader = msg[1]
+    file_name = text(msg[0])
+    uploader = text(msg[1])
     replica_node = network.id(host)
     
+    part_num = text(msg[2])
+
     # update my dfs with new replica info
-    manager.acknowledge_replica(file_name, uploader, replica_node)
+    manager.acknowledge_replica(file_name, uploader, replica_node, part_num)
     
-def handle_file_slice(msg):
-    msg = msg.split(Message.DELIMITER)
-    filename = msg[0]
-    part = msg[1]
-    total = msg[2]
-    data = msg[3]
+# An uploader lists the chunks of a file before sending it. Parts whose
+# chunks we already store are taken from the chunk store; we answer with
+# the parts that still have to be sent.
+def handle_manifest(msg, host):
+    file_name = text(msg[0])
+    uploader = text(msg[1])
+    total_parts = text(msg[2])
+    digests = bytes(msg[3])
+    digests = [digests[i:i + 32] for i in range(0, len(digests), 32)]
+    coding = parse_coding(msg[4]) if len(msg) > 4 else None
+
+    needed = manager.receive_manifest(file_name, uploader, total_parts, digests, coding)
+    logger.info("Already have %d/%d parts of %s" % (len(digests) - len(needed), len(digests), file_name))
+    network.send_need_parts(host, file_name, needed)
+
+    # nothing to send means nothing to acknowledge later, so do it now
+    if not needed:
+        network.broadcast_replica(file_name, uploader, total_parts, total_parts)
+
+def handle_need_parts(msg, host):
+    file_name = text(msg[0])
+    parts = [int(part) for part in text(msg[1]).split(",") if part]
+    manager.parts_needed(file_name, network.id(host), parts)
+
+def handle_file_slice(msg, host):
+    filename = text(msg[0])
+    part = text(msg[1])
+    total = text(msg[2])
+    offset = int(text(msg[3]))
+    size = int(text(msg[4]))
+    coding = parse_coding(msg[5])
+    data = msg[6]
 
     logger.info("Receiving %s/%s of file %s" % (part, total, filename))
    
     # write file data to files/filename
-    filewriter.write_to_file(filename, part, total, data)
+    manager.receive_slice(filename, part, total, offset, size, data, host, coding)
+
+# (shard index, k, m) from the coding field of a frame, None if it is empty
+def parse_coding(field):
+    field = text(field)
+    return tuple(int(n) for n in field.split(",")) if field else None
 
 def handle_users_msg(msg):
-    ids = msg.split(Message.DELIMITER)
+    ids = [text(id) for id in msg]
     network.add_users(ids)
 
 def handle_dfs_info_message(dfs_json_str):
     dfs_json = json.loads(dfs_json_str)
     manager.update_with_dfs_json(dfs_json)
 
-def handle_verify_msg(id, host):
+# A peer summarized its file table. Send back only the entries in buckets
+# where we differ; the peer does the same with ours, so both end up merged.
+def handle_dfs_digest_message(digest_json_str, host):
+    delta = manager.get_log_delta(json.loads(digest_json_str))
+    if delta:
+        network.send_dfs_info(host, delta)
+
+def handle_verify_msg(id, host, codecs):
     logger.info("Received id from %s" % (host))
 
     if network.verify_host(host, id):
+        network.negotiate_codec(host, codecs)
         network.broadcast_host(host)
 
         # this host reached out to you, now connect to it
@@ -207,9 +311,9 @@ def handle_verify_msg(id, host):
                 return False
 
         # do other handshake stuff
-        # send them your dfs info
+        # send them a digest of your dfs; they answer with what differs
         network.send_network_info(host)
-        network.send_dfs_info(host, manager.get_log())
+        network.send_dfs_digest(host, manager.get_digest())
 
         # send them network config info (trusted ids)
         network.send_network_info(host)
@@ -221,9 +325,8 @@ def handle_host_msg(new_host, host):
         network.connect_to_host(new_host)
 
 def handle_upload(msg, host):
-    msglist = msg.split(Message.DELIMITER)
-    filename = msglist[0]
-    uploader = msglist[1]
+    filename = text(msg[0])
+    uploader = text(msg[1])
 
     manager.add_to_fs(filename, uploader)
 
@@ -258,6 +361,12 @@ def user_interaction():
         elif text.startswith("upload"):
             filepath = text[7:]
             manager.upload_file(filepath)
+        elif text.startswith("priority"):
+            try:
+                filename, priority = text[9:].rsplit(" ", 1)
+                manager.set_priority(filename, float(priority))
+            except ValueError:
+                print("usage: priority [file_name] [0-1]")
         elif text.startswith("download"):
             try:
                 end_filename = text.index(" ", 9)
@@ -280,6 +389,11 @@ def user_interaction():
             network.connect_to_host(text[8:])
         elif text == "netinfo":
             network.print_all()
+        elif text == "netstats":
+            network.display_compression()
+            network.display_flush_stats()
+            manager.display_flush_stats()
+            manager.display_chunk_stats()
         elif text == "myinfo":
             print("%s as %s" % (my_host, my_id))
         elif text.startswith("verify"):
@@ -320,11 +434,13 @@ def print_help():
     print("nodes - print node list")
     print("files - print file list")
     print("upload [file_path] - add a file to the dfs")
+    print("priority [file_name] [0-1] - how available a file should be, from the next upload on")
     print("download [file_name] [path] - download file from the dfs")
     print("delete [file_name] - delete a file from the dfs")
     print("join")
     print("connect [host_name]")
     print("myinfo - print ip addr and userid")
+    print("netstats - print bytes saved by compression per node and coalesced disk writes")
     print("verify [user_id]")
     print("refresh")
     print("debug - toggle debugging mode")
@@ -338,20 +454,50 @@ if __name__ == "__main__":
 
     filewriter = Filewriter()
 
-    local_test = len(sys.argv) > 2
+    # flags can go anywhere, the rest are positional
+    flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+
+    if "--async" in flags:
+        engine = AsyncEngine()
+        engine.start()
+
+    local_test = len(args) > 1
 
     if local_test:
         print("You are running in testing mode")
 
     my_host = _get_ip() if not local_test else "127.0.0.1"
-    my_port = LISTEN_PORT if not local_test else int(sys.argv[2])
+    my_port = LISTEN_PORT if not local_test else int(args[1])
 
-    my_id = sys.argv[1]
+    my_id = args[0]
 
     profile = Entity(my_host, my_port, my_id)
-    network = Network(profile, local_test)
-
-    manager = DFSM.DFSManager(network, my_id, filewriter, "modules/dfs/dfs.json")
+    # --data-channels=N sets how many bulk connections to open per peer
+    data_channels = Network.DATA_CHANNELS
+    for flag in flags:
+        if flag.startswith("--data-channels="):
+            data_channels = int(flag.split("=")[1])
+
+    network = Network(profile, local_test, engine, "--no-compress" not in flags, data_channels)
+
+    # --erasure=M stores uploads as erasure coded shards, one per host, that
+    # survive any M of the hosts going away, instead of full copies
+    parity = 0
+    for flag in flags:
+        if flag.startswith("--erasure="):
+            parity = int(flag.split("=")[1])
+
+    # --journal appends dfs changes to a journal instead of rewriting dfs.json,
+    # otherwise dfs.json is rewritten in the background at most once a second.
+    # --sqlite keeps the file table in dfs.db instead, starting from dfs.json
+    if "--sqlite" in flags:
+        manager = DFSM.DFSManager(network, my_id, filewriter, "modules/dfs/dfs.db",
+                                  flush_interval=1, store="sqlite",
+                                  import_from="modules/dfs/dfs.json", parity=parity)
+    else:
+        manager = DFSM.DFSManager(network, my_id, filewriter, "modules/dfs/dfs.json",
+                                  journal="--journal" in flags, flush_interval=1, parity=parity)
 
     log = Log()
     logger = log.get_logger()
@@ -360,19 +506,25 @@ if __name__ == "__main__":
     # hello
     logger.info("Starting up")
 
-    listen = socket.socket()
+    if engine:
+        # listening and heartbeats all run on the engine's event loop
+        engine.serve(my_host, my_port, handle_frame, close_connection)
+        engine.every(5, lambda: network.broadcast_heartbeats(filewriter.free_space()))
+    else:
+        listen = socket.socket()
 
-    # tell os to recycle port quickly
-    listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # tell os to recycle port quickly
+        listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    # start up listening socket and thread
-    listen.bind((my_host, my_port))
-    listen.listen()
-    threading.Thread(target=listen_for_nodes, args=(listen,)).start()
+        # start up listening socket and thread
+        listen.bind((my_host, my_port))
+        listen.listen()
+        threading.Thread(target=listen_for_nodes, args=(listen,)).start()
 
-    # start up heatbeat thread
-    threading.Thread(target=send_heartbeats).start()
+        # start up heatbeat thread
+        threading.Thread(target=send_heartbeats).start()
 
-    # start up UI thread
-    threading.Thread(target=user_interaction).start()
+    # run the UI on the main thread. Returning from here would start interpreter
+    # shutdown, after which the asyncio engine's worker pool stops taking jobs
+    user_interaction()
 
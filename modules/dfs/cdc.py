@@ -0,0 +1,76 @@
+## Content-defined chunking
+##
+## Files are cut where the content says so, not every N bytes, so an insert
+## near the start of a file only changes the chunks around it and the rest
+## still deduplicate against an older version.
+##
+## A cut goes after every WIDTH-byte window whose bytes, each mapped to one
+## pseudo-random bit, spell out a fixed pattern. That is a rolling condition
+## on the last WIDTH bytes that holds with probability 2^-WIDTH, like a
+## rolling hash with WIDTH mask bits, but bytes.translate and bytes.find
+## evaluate it at C speed. Chunks are at least min_size and at most
+## max_size bytes, so on average min_size + 2^WIDTH.
+##
+## Why it resists shifts the way a gear or Rabin hash does: whether a cut
+## goes at some position depends only on the WIDTH bytes before it, never
+## on the offset in the file or on anything further back. An insert or
+## delete moves the candidate cuts after it along with the data, so once
+## the chunker has found one cut past the edit (and past min_size of the
+## previous one) it is back on the same cuts as the old file. Only the
+## chunks from the edit to that cut change, the same resync a rolling hash
+## gives.
+##
+## Where it is weaker than a gear hash: each byte contributes a single bit,
+## so content built from few distinct byte values can map to too few bit
+## patterns to ever match. Such content is cut every max_size bytes, which
+## does shift with edits. Runs of one byte value do that under a gear hash
+## too. Typical binary and text data has enough distinct bytes for the
+## cuts to land as expected.
+
+import hashlib
+import random
+
+WIDTH = 18
+
+# byte value -> 0 or 1, fixed so every node cuts the same way
+_rand = random.Random(0x646f6f66)
+_BITS = bytes(_rand.getrandbits(1) for i in range(256))
+_PATTERN = bytes(_rand.getrandbits(1) for i in range(WIDTH))
+
+
+# Yields (offset, data) for consecutive chunks of the open binary file
+def chunks(file, min_size, max_size):
+    buf = b""
+    bits = b""
+    pos = 0
+    offset = 0
+    eof = False
+
+    while True:
+        # keep at least one max size chunk buffered
+        if not eof and len(buf) - pos < max_size:
+            more = file.read(4 * max_size)
+            eof = not more
+            buf = buf[pos:] + more
+            bits = buf.translate(_BITS)
+            pos = 0
+
+        if pos == len(buf):
+            return
+
+        cut = _boundary(bits, pos, min_size, max_size)
+        yield offset, buf[pos:cut]
+        offset += cut - pos
+        pos = cut
+
+# End of the chunk starting at pos
+def _boundary(bits, pos, min_size, max_size):
+    end = min(len(bits), pos + max_size)
+    if end - pos <= min_size:
+        return end
+    at = bits.find(_PATTERN, max(pos, pos + min_size - WIDTH), end)
+    return at + WIDTH if at >= 0 else end
+
+# sha256 of a chunk, which is its address in the chunk store
+def digest(data):
+    return hashlib.sha256(data).digest()
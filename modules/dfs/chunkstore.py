@@ -0,0 +1,272 @@
+import os
+import mmap
+import struct
+from threading import Lock
+
+# Content-addressed storage for replica chunks, shared by every replica on
+# the node. A chunk is stored once under its sha256, however many files (or
+# versions of a file) contain it; files are Manifests of chunk digests.
+#
+# Chunks are appended to <folder>/data.seg and an index file,
+# <folder>/index, gets one fixed size record per chunk saying where it
+# landed. Storing a chunk writes just that chunk; reads go through a
+# read-only mmap of the segment, so the page cache holds the data and a
+# node's memory doesn't grow with what it stores; and a chunk's
+# (path, offset, length) can go straight to sendfile.
+#
+# The data is written before its index record, so a crash leaves at worst
+# unreferenced bytes at the end of the segment or a torn last record, and
+# both are ignored on load. The index is read on first use, not at startup.
+#
+# Soft state:
+#   _seg_name, _idx_name: the two files
+#   _index: digest -> (offset, length) in the segment, None until loaded
+#   _deduped: bytes that put() didn't store because they already were
+#   _seg, _idx: append handles, opened on the first put
+#   _fd: read descriptor for the segment, opened on the first read
+#   _map: mmap of the segment, remapped when a read is past its end
+#   _lock: guards all of the above
+class ChunkStore:
+
+    # sha256, offset, length
+    RECORD = struct.Struct("!32sQQ")
+
+    def __init__(self, folder):
+        self._folder = folder
+        self._seg_name = os.path.join(folder, "data.seg")
+        self._idx_name = os.path.join(folder, "index")
+        self._index = None
+        self._deduped = 0
+        self._seg = None
+        self._idx = None
+        self._fd = None
+        self._map = None
+        self._lock = Lock()
+
+    # Stores a chunk under its digest unless it is already here
+    def put(self, digest, data):
+        with self._lock:
+            self._load()
+            if digest in self._index:
+                self._deduped += len(data)
+                return
+            if not self._seg:
+                os.makedirs(self._folder, exist_ok=True)
+                self._seg = open(self._seg_name, "ab")
+                self._idx = open(self._idx_name, "ab")
+
+            offset = self._seg.seek(0, os.SEEK_END)
+            self._seg.write(data)
+            self._seg.flush()
+            self._idx.write(self.RECORD.pack(digest, offset, len(data)))
+            self._idx.flush()
+
+            self._index[digest] = (offset, len(data))
+
+    def get(self, digest):
+        with self._lock:
+            self._load()
+            offset, length = self._index[digest]
+            if not length:
+                return b""
+            if self._map is None or offset + length > len(self._map):
+                self._remap()
+            return self._map[offset:offset + length]
+
+    # (path, offset, length) of a chunk in the segment, None if not stored
+    def range(self, digest):
+        with self._lock:
+            self._load()
+            where = self._index.get(digest)
+        if not where:
+            return None
+        return self._seg_name, where[0], where[1]
+
+    def has(self, digest):
+        with self._lock:
+            self._load()
+            return digest in self._index
+
+    # has(), for a chunk that is about to be used again instead of stored:
+    # its bytes count as deduplicated
+    def reuse(self, digest):
+        with self._lock:
+            self._load()
+            if digest not in self._index:
+                return False
+            self._deduped += self._index[digest][1]
+            return True
+
+    # (chunks stored, bytes stored, bytes saved by deduplication)
+    def stats(self):
+        with self._lock:
+            self._load()
+            return len(self._index), sum(length for offset, length in self._index.values()), self._deduped
+
+    # Rewrites the segment with only the chunks in live. Ranges handed out
+    # earlier are invalid afterwards, so only call this while nothing is
+    # being served (Filewriter does it at startup).
+    def compact(self, live):
+        self.close()
+        with self._lock:
+            self._load()
+            keep = [digest for digest in self._index if digest in live]
+            if len(keep) == len(self._index):
+                return
+
+            index = {}
+            with open(self._seg_name, "rb") as old, open(self._seg_name + ".tmp", "wb") as seg, \
+                    open(self._idx_name + ".tmp", "wb") as idx:
+                for digest in keep:
+                    offset, length = self._index[digest]
+                    old.seek(offset)
+                    index[digest] = (seg.tell(), length)
+                    seg.write(old.read(length))
+                    idx.write(self.RECORD.pack(digest, index[digest][0], length))
+                seg.flush()
+                os.fsync(seg.fileno())
+                idx.flush()
+                os.fsync(idx.fileno())
+            os.replace(self._seg_name + ".tmp", self._seg_name)
+            os.replace(self._idx_name + ".tmp", self._idx_name)
+            self._index = index
+
+    def close(self):
+        with self._lock:
+            if self._seg:
+                self._seg.close()
+                self._idx.close()
+                self._seg = self._idx = None
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    # Reads the index if it hasn't been yet. Called under _lock
+    def _load(self):
+        if self._index is not None:
+            return
+        self._index = {}
+        try:
+            segment = os.path.getsize(self._seg_name)
+        except OSError:
+            segment = 0
+
+        # a record whose data never reached the segment is skipped
+        for digest, offset, length in read_records(self._idx_name, self.RECORD):
+            if offset + length <= segment:
+                self._index[digest] = (offset, length)
+
+    # Maps the whole segment as it is now. Called under _lock
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        if self._fd is None:
+            self._fd = os.open(self._seg_name, os.O_RDONLY)
+        self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+
+
+# Which chunks make up one replica: <base>.man holds one fixed size record
+# per part, appended as parts arrive, naming the part's chunk by digest.
+# A replica that is one shard of an erasure coded file says which in a
+# record for part 0, whose digest field holds the shard index, k and m.
+#
+# Soft state:
+#   _name: the manifest file
+#   _parts: part number -> chunk digest
+#   _total: total parts in the file, as last recorded
+#   _coding: (shard index, k, m), None for a full replica
+#   _file: append handle, opened on the first put
+#   _lock: guards all of the above
+class Manifest:
+
+    # part, total parts, sha256
+    RECORD = struct.Struct("!II32s")
+
+    # shard index, k, m, in the digest field of the part 0 record
+    CODING = struct.Struct("!HHH")
+
+    def __init__(self, base):
+        self._name = base + ".man"
+        self._parts = {}
+        self._total = None
+        self._coding = None
+        self._file = None
+        self._lock = Lock()
+
+        for part, total, digest in read_records(self._name, self.RECORD):
+            if part == 0:
+                coding = self.CODING.unpack_from(digest)
+                self._coding = coding if coding[1] else None
+                continue
+            self._parts[part] = digest
+            self._total = total
+
+    def put(self, part, total, digest):
+        part = int(part)
+        with self._lock:
+            if self._parts.get(part) == digest:
+                return
+            self._append(part, total, digest)
+            self._parts[part] = digest
+            self._total = int(total or 0)
+
+    def set_coding(self, total, coding):
+        with self._lock:
+            if coding == self._coding:
+                return
+            self._append(0, total, self.CODING.pack(*(coding or (0, 0, 0))).ljust(32, b"\0"))
+            self._coding = coding
+
+    def coding(self):
+        return self._coding
+
+    # Called under _lock
+    def _append(self, part, total, digest):
+        if not self._file:
+            self._file = open(self._name, "ab")
+        self._file.write(self.RECORD.pack(part, int(total or 0), digest))
+        self._file.flush()
+
+    def digest(self, part):
+        return self._parts.get(int(part))
+
+    def has(self, part):
+        return int(part) in self._parts
+
+    def parts(self):
+        return list(self._parts.keys())
+
+    def digests(self):
+        return set(self._parts.values())
+
+    def total(self):
+        return self._total
+
+    def remove(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self._name):
+                os.remove(self._name)
+            self._parts = {}
+            self._coding = None
+
+
+# Reads the fixed size records of an append-only file. A torn last record
+# is cut off, so records appended later start aligned.
+def read_records(name, record):
+    try:
+        with open(name, "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return []
+
+    whole = len(data) - len(data) % record.size
+    if whole != len(data):
+        with open(name, "r+b") as file:
+            file.truncate(whole)
+    return [record.unpack_from(data, start) for start in range(0, whole, record.size)]
@@ -2,25 +2,76 @@
 ## Soft state:
 ##  _fs: FS objet
 ##  _network: Network object
-##  _file_list: initial file list from FS object
-
+##  _part_size: bytes per part when files are split for transfer
+##  _parity: parity shards per part for erasure coded uploads, 0 for full replicas
+##  _priorities: filename -> priority set for its next upload
+##  _uploads: (filename, replica id) -> Upload in progress
+##  _downloads: filename -> Download in progress
+##  _shards: (filename, part) -> {shard index: shard} collected for a coded part
+##  _shards_lock: guards _shards, filled from every source's listener thread
+
+import threading
 from threading import Lock
 import modules.dfs.dfs as dfs
+from modules.dfs.sqlitedfs import SQLiteDFS
 from modules.dfs.filewriter import Filewriter
+from modules.dfs.transfer import Upload, Download
+from modules.dfs import cdc
+from modules.dfs import erasure
+from modules.dfs import placement
 
 class DFSManager:
 
-    def __init__(self, network, my_id, filewriter, log_name = None):
+    PART_SIZE    = 1024 * 1024
+    WINDOW       = 4     # parts in flight per peer
+    PART_TIMEOUT = 10    # seconds before an unanswered part is sent again
+    MAX_RETRIES  = 3     # per part, before giving up on the transfer
+    KEEP_BYTES   = 64 * 1024 * 1024  # encoded parts kept from chunking for sending
+    PRIORITY     = 0.5   # for files with none set, see placement.target
+
+    # store picks the file table backend: "json" keeps it in memory and in
+    # log_name, "sqlite" keeps it in the database log_name. With parity,
+    # uploads are erasure coded so that any parity hosts can be lost.
+    def __init__(self, network, my_id, filewriter, log_name = None, part_size = PART_SIZE,
+                 journal = False, flush_interval = None, store = "json", import_from = None,
+                 parity = 0):
         self._network   = network
         self._id        = my_id
-        self._fs        = dfs.DFS(log_name)
-        self._file_list = self._fs.list_files()
+        if store == "sqlite":
+            self._fs    = SQLiteDFS(log_name, flush_interval = flush_interval,
+                                    import_from = import_from)
+        else:
+            self._fs    = dfs.DFS(log_name, journal = journal, flush_interval = flush_interval)
         self._filewriter = filewriter
-
-    # Based on our failure model, calculates number of replicas needed
-    # given the priority and number of nodes
-    def _compute_replica_count(self, priority, node_count):
-        return node_count
+        self._part_size = part_size
+        self._parity    = parity
+        self._priorities = {}
+
+        self._uploads   = {}
+        self._downloads = {}
+        self._shards    = {}
+        self._shards_lock = Lock()
+
+    # Picks the fewest connected hosts that keep a file of size bytes
+    # reachable as often as its priority asks, going by how often each has
+    # been up and how much room it has. Returns (hosts, probability the file
+    # is reachable); the hosts that come closest if none reach the target.
+    def _place(self, size, priority):
+        candidates = []
+        for host in list(self._network._connected)[:erasure.MAX_SHARDS]:
+            id = self._network.id(host)
+            availability = self._network.availability(id)
+            candidates.append((host, placement.UNKNOWN if availability is None else availability,
+                               self._network.free_space(id)))
+        return placement.choose(candidates, size, placement.target(priority), self._parity)
+
+    # Erasure coding for a file going to this many hosts, one shard each:
+    # (data shards, parity shards). None means full replicas, when there's
+    # no parity configured or too few hosts for it
+    def _compute_coding(self, hosts):
+        if not self._parity or hosts <= self._parity:
+            return None
+        return hosts - self._parity, self._parity
 
     def get_DFS_ref(self):
         return self._fs
@@ -28,6 +79,18 @@ class DFSManager:
     def get_log(self):
         return self._fs.return_log()
 
+    # Summary of our file table for anti-entropy (see DFS.digest)
+    def get_digest(self):
+        return self._fs.digest()
+
+    # The part of our file table a peer with this digest is missing or
+    # disagrees on, in the same shape as get_log(). None if nothing differs.
+    def get_log_delta(self, digest):
+        buckets = self._fs.diff_digest(digest)
+        if not buckets:
+            return None
+        return {"files" : self._fs.files_in_buckets(buckets)}
+
     def update_with_dfs_json(self, dfs):
         files = dfs["files"]
         for file in files:
@@ -50,23 +113,43 @@ class DFSManager:
     def clear_files(self):
         self._fs.clear_files()
 
+    # Returns once the file table is on disk
+    def flush(self):
+        self._fs.flush()
+
+    def display_flush_stats(self):
+        stats = self._fs.flush_stats()
+        if stats:
+            print("dfs          %d changes in %d disk writes, %d coalesced" % stats)
+
 ##############################################
 
-    def acknowledge_replica(self, filename, uploader, replica_host):
+    def acknowledge_replica(self, filename, uploader, replica_host, part = None):
+        # a part we are uploading made it
+        upload = self._uploads.get((filename, replica_host))
+        if upload and part:
+            upload.window.answered(int(part))
+
         if self._fs.check_file(filename, uploader):
-            self._fs.add_replicas(filename, replica_host)
+            file = self._fs.get_file(filename)
+            if replica_host not in file["replicas"]:
+                self._fs.add_replicas(filename, replica_host)
         else:
             self._fs.add_file(filename, uploader, [replica_host])
 
-    def upload_file(self, filepath, priority = 0.5):
+    # priority defaults to the one set for the file, else PRIORITY
+    def upload_file(self, filepath, priority = None):
         filename = filepath[filepath.rfind("/") + 1:]
 
-        if self._fs.check_file(filename, self._id):
-            print("This file is already on the dfs")
+        if any(name == filename for name, host in self._uploads):
+            print("Already uploading %s" % (filename))
             return False
-            #raise dfs.DFSAddFileError(filename, self._id)
 
-        ## choose replicas (all)
+        # hosts answer the manifest with only the parts they lack, so
+        # uploading again finishes an upload that was cut off
+        if self._fs.check_file(filename, self._id):
+            print("Resuming upload of %s" % (filename))
+
         total_nodes = len(self._network._connected)
 
         if not total_nodes:
@@ -74,30 +157,166 @@ class DFSManager:
             return False
         #raise DFSManagerAddFileError(filename)
 
-        num_replicas = self._compute_replica_count(priority, total_nodes)
-
-        ## call network send file function
-        i = 0
-        ## currently just adds to host in order
-        for host in self._network._connected:
-            if i == num_replicas:
-                break
-            data = self._filewriter.read_from_file(filepath)
-            if not data:
-                print("No such file: %s" % (filepath))
-                return False
-            self._network.send_replica(host, filename, self._id, "1", "1", data)
+        size = self._filewriter.file_size(filepath)
+        if size is False:
+            print("No such file: %s" % (filepath))
+            return False
 
-            i += 1
+        if priority is None:
+            priority = self._priorities.get(filename, self.PRIORITY)
+        hosts, reachable = self._place(size, priority)
+        if not hosts:
+            print("No node has room for %s" % (filename))
+            return False
+        print("Placing %s on %d of %d nodes: %.3f%% available, target %.3f%%"
+              % (filename, len(hosts), total_nodes, 100 * reachable, 100 * placement.target(priority)))
+
+        threading.Thread(target=self._start_uploads, args=(filename, filepath, hosts)).start()
+        return True
+
+    # Cuts the file into content-defined chunks, one per part, and sends
+    # it to every host. Chunking reads the whole file, so it runs here
+    # rather than on the caller's thread. Each host sees the digests of what
+    # it is to store first and only gets the parts it lacks. What chunking
+    # encoded is kept, up to KEEP_BYTES, so those parts aren't read and
+    # encoded a second time to be sent.
+    def _start_uploads(self, filename, filepath, hosts):
+        coding = self._compute_coding(len(hosts))
+        encode = self._encoder(filepath, coding)
+        kept = {}
+        room = [self.KEEP_BYTES]
+        def encode_and_keep(offset, data):
+            pieces = encode(offset, data)
+            size = sum(len(piece) for piece in pieces)
+            # only the front of the file, which is sent first
+            if size <= room[0]:
+                room[0] -= size
+                kept[offset] = pieces
+            else:
+                room[0] = -1
+            return pieces
+        chunks = self._filewriter.chunk_file(filepath, self._part_size // 16, self._part_size, encode_and_keep)
+        if not chunks:
+            chunks = [(0, 0, [cdc.digest(piece) for piece in encode(0, b"")])]
+        if coding:
+            print("Storing %s as %d data and %d parity shards per part" % (filename, coding[0], coding[1]))
+
+        uploads = []
+        for index, host in enumerate(hosts):
+            upload = Upload(filename, host, len(chunks), self.WINDOW, self.PART_TIMEOUT)
+            upload.shard = index if coding else 0
+            self._uploads[(filename, self._network.id(host))] = upload
+            self._network.send_manifest(host, filename, self._id, str(len(chunks)),
+                                        [digests[upload.shard] for offset, length, digests in chunks],
+                                        (index,) + coding if coding else None)
+            uploads.append(upload)
+
+        try:
+            for upload in uploads:
+                upload.await_needs(self.PART_TIMEOUT)
+                print("Sending %s to %s (%d parts)..." % (filename, upload.host, upload.remaining()))
+            self._run_uploads(uploads, filepath, chunks, encode, kept)
+        finally:
+            for upload in uploads:
+                self._uploads.pop((filename, self._network.id(upload.host)), None)
+
+    # What each host stores of a part of the file at filepath, given where
+    # the part starts: the part itself, or with coding one shard per host
+    def _encoder(self, filepath, coding):
+        if not coding:
+            return lambda offset, data: [data]
+        size = self._filewriter.file_size(filepath)
+        k, m = coding
+        return lambda offset, data: erasure.encode(data, k, m, offset, size)
+
+    # Sends the parts of one file to all its replica hosts. Parts kept from
+    # chunking (kept maps offset -> pieces) go first, then the file is read
+    # once, front to back, for the rest. Each part goes to every host that
+    # needs it (or its shard of it) as it is read, so past KEEP_BYTES memory
+    # holds a part at a time (plus what the send queues hold) however many
+    # hosts there are. Each host keeps at most WINDOW parts unacknowledged;
+    # the read waits for the slowest one.
+    def _run_uploads(self, uploads, filepath, chunks, encode, kept):
+        parts = sorted(set(part for upload in uploads for part in upload.unsent()))
+        active = list(uploads)
+
+        for part, pieces in self._pieces(filepath, chunks, encode, parts, kept):
+            active = [upload for upload in active
+                      if self._send_through(upload, filepath, chunks, encode, part, pieces[upload.shard])]
+            if not active:
+                return
+
+        # resend what gets lost until every host has everything
+        while active:
+            for upload in list(active):
+                if upload.done():
+                    print("Finished sending %s to %s" % (upload.filename, upload.host))
+                    active.remove(upload)
+                elif not self._send_through(upload, filepath, chunks, encode, upload.total):
+                    active.remove(upload)
+            if active:
+                active[0].window.wait(1)
+
+    # (part, pieces) for each of parts, in order: taken out of kept where
+    # chunking left them (a front of the file), else read and encoded again.
+    # Kept parts no host needs are dropped straight away
+    def _pieces(self, filepath, chunks, encode, parts, kept):
+        cached = [(part, kept[chunks[part - 1][0]]) for part in parts if chunks[part - 1][0] in kept]
+        missing = [part for part in parts if chunks[part - 1][0] not in kept]
+        kept.clear()
+        while cached:
+            yield cached.pop(0)
+        for part, data in self._filewriter.read_chunks(filepath, chunks, missing):
+            yield part, encode(chunks[part - 1][0], data)
+
+    # Sends upload every part it still needs up to and including part,
+    # as window room allows. data is what the host stores of that part;
+    # lost parts before it are read from the file (and encoded) again.
+    # Returns False if the upload was abandoned.
+    def _send_through(self, upload, filepath, chunks, encode, part, data = None):
+        host = upload.host
+        while True:
+            if not self._network.connected(host):
+                print("Lost connection to %s while sending %s" % (host, upload.filename))
+                return False
 
-        #self._fs.add_file(filename, self._id)
-        
-        # ####### Don't need this because the replicas will tell them
-        # send dfs with updated file list to everyone
-        #for host in self._network.get_connected_nodes():
-         #   print("about to tell host %s the new dfs" % (host))
-          #  self._network.add_file(host, filename, self._id) # Send metadata telling hosts about new file   
+            if not upload.requeue(upload.window.expired(), self.MAX_RETRIES):
+                print("Gave up sending %s to %s" % (upload.filename, host))
+                return False
 
+            next = upload.peek()
+            if next is None or next > part:
+                return True
+            if not upload.window.has_room():
+                upload.window.wait(1)
+                continue
+
+            upload.next_part()
+            if next != part or data is None:
+                offset, length, digests = chunks[next - 1]
+                payload = encode(offset, self._filewriter.read_chunk(filepath, offset, length))[upload.shard]
+            else:
+                payload = data
+            upload.window.sent(next)
+            self._network.send_replica(host, upload.filename, self._id, str(next), str(upload.total), payload)
+
+    # The host holding a replica for us answered our manifest
+    def parts_needed(self, filename, replica_id, parts):
+        upload = self._uploads.get((filename, replica_id))
+        if upload:
+            upload.need(parts)
+
+    # An uploader's manifest for a replica we are to store, coding saying
+    # which shard of the file it is if erasure coded. Returns the parts we
+    # don't already have the chunks for.
+    def receive_manifest(self, filename, uploader, total, digests, coding = None):
+        needed = self._filewriter.receive_manifest(filename, total, digests, coding)
+        if len(needed) < len(digests):
+            self.acknowledge_replica(filename, uploader, self._id)
+        return needed
+
+    def display_chunk_stats(self):
+        print("chunks       %d stored in %d bytes, %d bytes deduplicated" % self._filewriter.chunk_stats())
 
     def store_replica(self, filename, uploader, part, total, data):
         ## add replica to dfs
@@ -133,8 +352,10 @@ class DFSManager:
 
         file_replicas = file["replicas"]
 
-        if self._id in file_replicas:
-            self._filewriter.write_to_file(filename)
+        # a shard of a coded file is no use alone, so that takes a download
+        if self._id in file_replicas and not self._filewriter.coding(filename):
+            self._filewriter.write_from_replica(filename)
+            return
 
         ## Find active replicas
         ##active_hosts  = self._network._connected
@@ -150,7 +371,110 @@ class DFSManager:
             return
             #raise DFSManagerDownloadError(filename, "No active replicas of file")
 
-        self._network.request_file(active_replicas[0], filename, "1", "1")
+        if filename in self._downloads:
+            print("Already downloading %s" % (filename))
+            return
+
+        download = Download(filename, active_replicas, self.WINDOW, self.PART_TIMEOUT)
+        done = self._filewriter.resume_download(filename)
+        if done:
+            total = int(self._filewriter.get_total(filename))
+            print("Resuming %s, %d/%d parts already downloaded" % (filename, len(done), total))
+            download.resume(done, total)
+        self._downloads[filename] = download
+        threading.Thread(target=self._run_download, args=(download,)).start()
+
+    # Spreads part requests over every source of the download. Faster sources
+    # get bigger windows, parts that stall on one source are handed to the
+    # next one with room, and sources that keep stalling or disconnect are dropped.
+    def _run_download(self, download):
+        print("Downloading %s from %d replicas..." % (download.filename, len(download.sources)))
+        try:
+            while not download.done():
+                for host in list(download.sources):
+                    source = download.sources[host]
+                    if not self._network.connected(host) or source.stalls > self.MAX_RETRIES:
+                        print("Dropping %s as a source of %s" % (host, download.filename))
+                        download.drop_source(host)
+
+                if not download.sources:
+                    print("No replicas left to download %s from" % (download.filename))
+                    return
+
+                if not download.reassign_stalled(self.MAX_RETRIES):
+                    print("Gave up downloading %s" % (download.filename))
+                    return
+
+                download.rebalance()
+                total = str(download.total) if download.total else "0"
+                requested = False
+                for source in download.ranked_sources():
+                    while source.window.has_room():
+                        part = download.next_part(source.host)
+                        if part is None:
+                            break
+                        source.window.sent(part)
+                        self._network.request_file(source.host, download.filename, str(part), total)
+                        requested = True
+
+                if not requested:
+                    download.wait(1)
+
+            print("Downloaded %s" % (download.filename))
+        finally:
+            self._downloads.pop(download.filename, None)
+            with self._shards_lock:
+                for key in [key for key in self._shards if key[0] == download.filename]:
+                    del self._shards[key]
+
+    # A part of a file we asked for arrived from host. It goes at offset
+    # in the file, which is size bytes. With coding it is one shard, and
+    # the part is rebuilt and written once any k have arrived.
+    def receive_slice(self, filename, part, total, offset, size, data, host = None, coding = None):
+        part = int(part)
+        download = self._downloads.get(filename)
+
+        # late slices, after the download ended, and second answers for a
+        # part (a stalled part asked again of another host) aren't written.
+        # A second answer still frees its source's window
+        if not download:
+            return
+        if download.has_part(part):
+            download.received(part, int(total), len(data), host)
+            return
+
+        if coding:
+            index, k, m = coding
+
+            # a shard of our own counts, so one fewer host has to answer
+            own = self._own_shard(filename, part, k, m)
+            download.set_pieces(k - 1 if own else k)
+            with self._shards_lock:
+                shards = self._shards.setdefault((filename, part), {})
+                shards[index] = bytes(data)
+                if own:
+                    shards[own[0]] = own[1]
+                ready = len(shards) >= k
+                if ready:
+                    del self._shards[(filename, part)]
+            if not ready:
+                download.received(part, int(total), len(data), host)
+                return
+            offset, size, data = erasure.decode(shards, k, m)
+
+        # a part that doesn't fit the file is dropped and asked for again
+        # once its request times out
+        if not self._filewriter.write_to_file(filename, part, total, data, offset, size):
+            return
+        download.received(part, int(total), len(data), host)
+
+    # (index, shard) of a part of a coded file, if we store a shard of it
+    # coded the same way
+    def _own_shard(self, filename, part, k, m):
+        coding = self._filewriter.coding(filename)
+        if not coding or coding[1:] != (k, m) or not self._filewriter.has_part(filename, part):
+            return None
+        return coding[0], bytes(self._filewriter.read_from_replica(filename, part))
 
     def delete_file(self, filename):
         ## remove from disk (if present)
@@ -161,6 +485,12 @@ class DFSManager:
             print("Invalid name")
             return
 
+        # REMOVE_FILE is a control frame and could overtake replica parts
+        # still on their way over the data connections
+        if any(name == filename for name, host in self._uploads):
+            print("Still uploading %s" % (filename))
+            return
+
         # Check that you are a replica before removing file from disk
         file_replicas = file["replicas"]
         if self._id in file_replicas:
@@ -174,9 +504,29 @@ class DFSManager:
 
         print("Deleted %s" % (filename))
 
+    # Sets how available a file should be (0 to 1, see placement.target)
+    # from its next upload on, and says how available it is now
     def set_priority(self, filename, priority):
-        ## punt
-        pass
+        file = self._fs.get_file(filename)
+        if not file:
+            print("Invalid name")
+            return
+
+        self._priorities[filename] = priority
+
+        # only a shard's holder knows the file is coded
+        coding = self._filewriter.coding(filename) if self._id in file["replicas"] else None
+        availabilities = []
+        for user in file["replicas"]:
+            availability = self._network.availability(user)
+            availabilities.append(placement.UNKNOWN if availability is None else availability)
+        reachable = placement.reachable(availabilities, coding[2] if coding else 0)
+        goal = placement.target(priority)
+
+        print("%s is %.3f%% available on %d nodes, target %.3f%%"
+              % (filename, 100 * reachable, len(availabilities), 100 * goal))
+        if reachable < goal and file["uploader"] == self._id:
+            print("Upload it again to place it on more nodes")
 
     def node_offline(self, node):
         ## punt
@@ -0,0 +1,140 @@
+## Reed-Solomon erasure coding over GF(256)
+##
+## A part is cut into k data shards and m parity shards of equal size, one
+## per host, and any k of them rebuild it: m hosts can be lost for (k + m) / k
+## times the part's size in storage, where full replicas take k + m times.
+## The code is systematic (the data shards are the part itself, cut in k)
+## and the parity rows come from a Cauchy matrix, so every k rows of the
+## encoding matrix can be inverted.
+##
+## Multiplying a shard by a constant is a table lookup per byte and adding
+## two is a xor. With numpy both run over whole shards at once; without it
+## bytes.translate does the lookup and the xor goes through python ints,
+## which are C loops too, just slower ones.
+
+import struct
+
+# numpy is optional
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# at most this many shards per part
+MAX_SHARDS = 256
+
+# what every shard starts with: where its part goes in the file, the part's
+# length and the file size, so a downloader can place a rebuilt part
+SHARD = struct.Struct("!QQQ")
+
+# log and antilog tables for x^8 + x^4 + x^3 + x^2 + 1
+_EXP = [0] * 512
+_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    _EXP[_i] = _x
+    _LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    _EXP[_i] = _EXP[_i - 255]
+
+def _mul(a, b):
+    if not a or not b:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+def _inv(a):
+    return _EXP[255 - _LOG[a]]
+
+# c -> c * x for every byte x
+_TABLES = [bytes(_mul(c, x) for x in range(256)) for c in range(256)]
+_NP_TABLES = numpy.frombuffer(b"".join(_TABLES), dtype=numpy.uint8).reshape(256, 256) if numpy else None
+
+# (k, rows used) -> inverse of those rows of the encoding matrix
+_inverses = {}
+
+
+# The k + m shards of a part that goes at offset in a file of size bytes
+def encode(data, k, m, offset, size):
+    if k + m > MAX_SHARDS:
+        raise ErasureError("%d shards, at most %d" % (k + m, MAX_SHARDS))
+    head = SHARD.pack(offset, len(data), size)
+    width = -(-len(data) // k)
+    data = bytes(data) + bytes(width * k - len(data))
+    pieces = [data[i * width:(i + 1) * width] for i in range(k)]
+    parity = [_combine(row, pieces, width) for row in _parity_rows(k, m)]
+    return [head + piece for piece in pieces + parity]
+
+
+# Rebuilds a part from any k of its shards (index -> shard). Returns
+# (offset, file size, part)
+def decode(shards, k, m):
+    if len(shards) < k:
+        raise ErasureError("%d of %d shards" % (len(shards), k))
+
+    # data shards first: each one present is a piece of the part as it is
+    rows = sorted(shards)[:k]
+    offset, length, size = SHARD.unpack_from(shards[rows[0]])
+    pieces = [memoryview(shards[row])[SHARD.size:] for row in rows]
+    width = len(pieces[0])
+
+    if rows == list(range(k)):
+        data = b"".join(pieces)
+    else:
+        inverse = _inverse(k, m, rows)
+        data = b"".join(bytes(pieces[j]) if rows[j] == j else _combine(inverse[j], pieces, width)
+                        for j in range(k))
+    return offset, size, data[:length]
+
+
+# Parity rows of the encoding matrix, 1 / (x_i + y_j) with the x_i and y_j
+# distinct
+def _parity_rows(k, m):
+    return [[_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+
+# sum of coefficients[j] * pieces[j], each piece width bytes
+def _combine(coefficients, pieces, width):
+    if numpy is not None:
+        total = numpy.zeros(width, dtype=numpy.uint8)
+        for coefficient, piece in zip(coefficients, pieces):
+            if coefficient:
+                total ^= _NP_TABLES[coefficient][numpy.frombuffer(piece, dtype=numpy.uint8)]
+        return total.tobytes()
+
+    total = 0
+    for coefficient, piece in zip(coefficients, pieces):
+        if coefficient:
+            total ^= int.from_bytes(bytes(piece).translate(_TABLES[coefficient]), "big")
+    return total.to_bytes(width, "big")
+
+# Inverse of the encoding matrix rows for shards rows, by Gauss-Jordan
+def _inverse(k, m, rows):
+    key = (k, tuple(rows))
+    if key in _inverses:
+        return _inverses[key]
+
+    parity = _parity_rows(k, m)
+    matrix = [([int(row == j) for j in range(k)] if row < k else list(parity[row - k]))
+              + [int(i == j) for j in range(k)] for i, row in enumerate(rows)]
+    for col in range(k):
+        pivot = next(r for r in range(col, k) if matrix[r][col])
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        scale = _inv(matrix[col][col])
+        matrix[col] = [_mul(scale, x) for x in matrix[col]]
+        for r in range(k):
+            factor = matrix[r][col]
+            if r != col and factor:
+                matrix[r] = [x ^ _mul(factor, y) for x, y in zip(matrix[r], matrix[col])]
+
+    _inverses[key] = [row[k:] for row in matrix]
+    return _inverses[key]
+
+
+###########################
+## Erasure coding Exceptions
+###########################
+class ErasureError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, "Erasure coding error: " + msg)
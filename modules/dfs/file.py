@@ -1,73 +1,243 @@
+import os
 import json
+import base64
+import struct
+from os import remove, path
 from threading import Lock
-from os import remove
+from .chunkstore import Manifest, read_records
+from . import cdc
 
 class File:
 
-    # updates dict of indexed chunks and then serializes chunks to json file
-    def __init__(self, filename, num_parts):
-        self._lock = Lock()
+    # part, total parts, file size
+    PARTS = struct.Struct("!IIQ")
 
+    # Replica parts are chunks in the node's shared ChunkStore, listed in a
+    # Manifest at replicas/<filename>.man. Parts of a download we aren't a
+    # replica for go straight into the destination file at their offset as
+    # they arrive; _received has a bit per part saying which are in. Each
+    # part that lands is also appended to <destination>.parts, so a
+    # download cut off by a dropped peer or a restart picks up where it was.
+    def __init__(self, filename, num_parts, chunks):
         self._filename = filename
 
         # default download folder
         self._path = "files/"
 
         # where you write replicas
-        self._replicaname = "replicas/" + filename + ".json"
-
-        # if you already have the replica, load from file
-        try:
-            with open(self._replicaname) as file:
-                jsonfile = json.load(file)
-                self._total_parts = jsonfile[0]
-                self._contents = jsonfile[1]   
-        except:
-            self._total_parts = num_parts
-            self._contents = {}
-        
+        self._chunks = chunks
+        self._manifest = Manifest("replicas/" + filename)
+
+        # where each replica part starts in the file, and the file size last
+        self._layout = None
+
+        # download in progress
+        self._fd = None
+        self._journal = None
+        self._size = None
+        self._received = None
+        self._count = 0
+        self._complete = False
+        self._lock = Lock()
+
+        # replicas from before the chunk store are moved into it once
+        self._migrate_json("replicas/" + filename + ".json")
+        self._migrate_segment("replicas/" + filename)
+
+        stored = self._manifest.total()
+        self._total_parts = stored if stored else num_parts
+
+    # Moves a replica kept as one json dict of parts into the store. Parts
+    # are base64 when the file says so, plain text in replicas from before
+    # the binary protocol
+    def _migrate_json(self, jsonname):
+        if not path.exists(jsonname):
+            return
+        with open(jsonname) as file:
+            replica = json.load(file)
+        total, parts = replica[:2]
+        decode = base64.b64decode if replica[2:] == ["base64"] else str.encode
+        for part in sorted(parts, key=int):
+            self._put(part, total, decode(parts[part]))
+        remove(jsonname)
+
+    # Moves a replica kept as its own segment (<base>.seg, with an index of
+    # part, total, offset, length records in <base>.idx) into the store
+    def _migrate_segment(self, base):
+        if not path.exists(base + ".idx"):
+            return
+        records = read_records(base + ".idx", struct.Struct("!IIQQ"))
+        if records:
+            with open(base + ".seg", "rb") as seg:
+                for part, total, offset, length in records:
+                    seg.seek(offset)
+                    self._put(part, total, seg.read(length))
+        for name in [base + ".seg", base + ".idx"]:
+            if path.exists(name):
+                remove(name)
+
+    def _put(self, part, total, data):
+        digest = cdc.digest(data)
+        self._chunks.put(digest, data)
+        self._manifest.put(part, total, digest)
+        self._layout = None
+
     def write_to_replica(self, part, data):
-        self._lock.acquire()
-
-        # add part to contents and dump to json
-        self._contents[str(part)] = data
-        
-        with open(self._replicaname, "w+") as file:
-            jsonfile = [self._total_parts, self._contents]
-            json.dump(jsonfile, file)
-
-        self._lock.release()
-
-    def write_to_file(self, part, data):
-        # if you don't have this part add it to contents to write
-        if data:
-            self._contents[part] = data
-        
-        print("%d/%s parts written" % (len(self._contents), self._total_parts))
-        
-        # if you have all parts write to disk
-        if (len(self._contents) == int(self._total_parts)):
-            print("writing %s to disk" % (self._filename))
-            
-            # clear contents of file
-            open(self._path + self._filename, 'w+').close()
-            
-            # append each part to file
-            with open(self._path + self._filename, "a+") as file:
-                for i in range (1, int(self._total_parts) + 1):
-                    file.write(self._contents[str(i)])
+        self._put(part, self._total_parts, bytes(data))
+
+    # Records the parts of a manifest whose chunks we already hold, without
+    # any data moving. Parts we have from an interrupted upload of the same
+    # file count. coding says which erasure coded shard of the file this
+    # replica is, if it is one. Returns the parts still needed.
+    def adopt(self, digests, coding = None):
+        self._manifest.set_coding(self._total_parts, coding)
+        needed = []
+        for part, digest in enumerate(digests, 1):
+            if self._manifest.digest(part) == digest:
+                continue
+            if self._chunks.reuse(digest):
+                self._manifest.put(part, self._total_parts, digest)
+            else:
+                needed.append(part)
+        self._layout = None
+        return needed
+
+    # (shard index, k, m) if this replica is a shard of an erasure coded
+    # file, else None
+    def coding(self):
+        return self._manifest.coding()
+
+    # Where a replica part goes in the file, as (offset, file size). Known
+    # once every part is stored, None until then. For a shard these are the
+    # shards' own offsets, and the downloader goes by the shard header.
+    def part_position(self, part):
+        layout = self._layout
+        if layout is None:
+            layout = [0]
+            for i in range(1, int(self._total_parts or 0) + 1):
+                digest = self._manifest.digest(i)
+                where = self._chunks.range(digest) if digest else None
+                if not where:
+                    return None
+                layout.append(layout[-1] + where[2])
+            self._layout = layout
+        return layout[int(part) - 1], layout[-1]
+
+    # Writes a downloaded part at offset in the destination. The first part
+    # to arrive creates the destination at its full size. Once every part
+    # is in, writes are ignored until the next download starts. Returns
+    # False, writing nothing, for a part that doesn't fit the file: one
+    # outside 1..total or data outside the file's size.
+    def write_to_file(self, part, data, offset, size):
+        part = int(part) - 1
+        if not 0 <= part < int(self._total_parts) or size < 0 \
+                or offset < 0 or offset + len(data) > size:
+            print("Dropped part %d of %s: outside the file" % (part + 1, self._filename))
+            return False
+        with self._lock:
+            if self._complete:
+                return True
+            # a different size or part count means the file changed since the
+            # parts we have
+            if self._received is None or size != self._size \
+                    or len(self._received) != (int(self._total_parts) + 7) // 8:
+                self._close_destination()
+                self._open_destination(size)
+            if self._received[part // 8] & (1 << part % 8):
+                return True
+
+            # the data goes before the record of it
+            os.pwrite(self._fd, data, offset)
+            self._journal.write(self.PARTS.pack(part + 1, int(self._total_parts), size))
+            self._journal.flush()
+            self._received[part // 8] |= 1 << part % 8
+            self._count += 1
+            print("%d/%s parts written" % (self._count, self._total_parts))
+
+            if self._count == int(self._total_parts):
+                self._close_destination()
+                self._complete = True
+                remove(self._journal_name())
+                print("wrote %s to disk" % (self._filename))
+        return True
+
+    # Picks up an unfinished download into the destination, left by this
+    # run or an earlier one. Returns the parts already there. Called as
+    # every download starts.
+    def resume_download(self):
+        with self._lock:
+            self._complete = False
+            if self._received is None:
+                records = read_records(self._journal_name(), self.PARTS)
+                if not records or not path.exists(self._path + self._filename):
+                    return []
+                part, total, size = records[-1]
+                self._total_parts = total
+                self._open_destination(size, resume = True)
+                for part, total, size in records:
+                    if total == self._total_parts and size == self._size:
+                        self._received[(part - 1) // 8] |= 1 << (part - 1) % 8
+                self._count = sum(bin(byte).count("1") for byte in self._received)
+
+            return [part + 1 for part in range(int(self._total_parts))
+                    if self._received[part // 8] & (1 << part % 8)]
+
+    def _journal_name(self):
+        return self._path + self._filename + ".parts"
+
+    # Called under _lock
+    def _open_destination(self, size, resume = False):
+        self._fd = os.open(self._path + self._filename, os.O_WRONLY | os.O_CREAT, 0o644)
+        os.ftruncate(self._fd, size)
+        if size and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(self._fd, 0, size)
+        self._journal = open(self._journal_name(), "ab" if resume else "wb")
+        self._size = size
+        self._received = bytearray((int(self._total_parts) + 7) // 8)
+        self._count = 0
+
+    # Called under _lock
+    def _close_destination(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._journal.close()
+        self._fd = self._journal = self._size = self._received = None
+        self._count = 0
+
+    # Writes the file out of our own replica, which must be a full one
+    def write_from_replica(self):
+        have = len(self._manifest.parts())
+        if have < int(self._total_parts):
+            print("%d/%s parts stored" % (have, self._total_parts))
+            return
+
+        print("writing %s to disk" % (self._filename))
+        with open(self._path + self._filename, "wb") as file:
+            for i in range(1, int(self._total_parts) + 1):
+                file.write(self.read_from_replica(i))
 
     def read_from_replica(self, part):
-        return self._contents[str(part)]
+        return self._chunks.get(self._manifest.digest(part))
+
+    # Where a part sits on disk as raw bytes, as (path, offset, length), so it
+    # can be served with sendfile. None if we don't store it
+    def replica_range(self, part):
+        digest = self._manifest.digest(part)
+        return self._chunks.range(digest) if digest else None
 
+    # Only the manifest goes; the chunks may be shared with other replicas
+    # and are collected by Filewriter
     def remove(self):
-        remove(self._replicaname)
+        self._manifest.remove()
 
-    def get_parts(self):
-        return list(self._contents.keys())
+    def digests(self):
+        return self._manifest.digests()
+
+    def has_part(self, part):
+        return self._manifest.has(part)
 
     def set_path(self, path):
-        
+
         if not path[-1] == "/":
             path += "/"
 
@@ -75,3 +245,7 @@ class File:
 
     def set_total(self, total):
         self._total_parts = total
+        self._layout = None
+
+    def get_total(self):
+        return self._total_parts
@@ -1,51 +1,173 @@
 from .file import File
-from os import listdir
+from .chunkstore import ChunkStore, Manifest
+from . import cdc
+from os import listdir, path, remove, makedirs
+from shutil import disk_usage
+from threading import Lock
 
 # stores a dict of files and writes to them
+# Replicas already on disk are only listed at startup. Each is opened the
+# first time it is used, so startup time and memory don't depend on how
+# much a node stores.
+#
+# Replica data lives in one content-addressed ChunkStore, so chunks shared
+# between files (or versions of a file) are stored once. Removing a replica
+# only drops its manifest; the chunks nothing refers to any more are
+# collected at the next startup.
+#
+# Soft state:
+#   _files: filename -> open File
+#   _stored: replicas on disk that haven't been opened yet
+#   _chunks: the node's chunk store
+#   _lock: guards opening, so a file is only opened once
 class Filewriter:
 
+    CHUNKS = "replicas/chunks"
+
+    # set when a replica is removed, so the next startup collects garbage
+    GARBAGE = "replicas/chunks/garbage"
+
     def __init__(self):
         self._files = {}
+        self._stored = set()
+        self._lock = Lock()
+        self._chunks = ChunkStore(self.CHUNKS)
         replicas = listdir("replicas/")
-        # add all existing files
+        # note all existing files: manifests, and replicas from before the
+        # chunk store (a json file or a segment and index each), which File
+        # migrates when opened
         for file in replicas:
-            filename = file[:-5]
-            ext = file[-5:]
-            if ext == ".json":
-                print("loading %s replica" % filename)
-                self.add_file(filename)
+            filename, ext = path.splitext(file)
+            if ext in [".man", ".idx", ".json"]:
+                self._stored.add(filename)
+
+        if path.exists(self.GARBAGE):
+            self._collect()
 
     def add_file(self, filename, total = None):
-        if not filename in self._files:
-            self._files[filename] = File(filename, total)
-        elif total:
-            self._files[filename].set_total(total)
+        self._lock.acquire()
+        try:
+            if not filename in self._files:
+                self._files[filename] = File(filename, total, self._chunks)
+                self._stored.discard(filename)
+            elif total:
+                self._files[filename].set_total(total)
+        finally:
+            self._lock.release()
+
+    # The File for filename, opening a stored replica on first use
+    def _file(self, filename):
+        if filename not in self._files:
+            self.add_file(filename)
+        return self._files[filename]
 
     def write_to_replica(self, filename, part, total, data):
         self.add_file(filename, total)
         self._files[filename].write_to_replica(part, data)
 
-    def write_to_file(self, filename, part = None, total = None, data = None):
+    # Writes a part of a download at offset in the destination, a file of
+    # size bytes. False if the part doesn't fit the file
+    def write_to_file(self, filename, part, total, data, offset, size):
         self.add_file(filename, total)
-        self._files[filename].write_to_file(part, data)
+        return self._files[filename].write_to_file(part, data, offset, size)
+
+    # Parts of filename already in its destination from a download that
+    # didn't finish
+    def resume_download(self, filename):
+        self.add_file(filename)
+        return self._files[filename].resume_download()
+
+    # Writes a file we hold a replica of to its destination
+    def write_from_replica(self, filename):
+        self._file(filename).write_from_replica()
 
     def read_from_replica(self, filename, part):
-        return self._files[filename].read_from_replica(part)
+        return self._file(filename).read_from_replica(part)
+
+    # (offset, file size) of a replica part in its file, or None if we don't
+    # have the whole replica
+    def part_position(self, filename, part):
+        return self._file(filename).part_position(part)
+
+    # (path, offset, length) of a replica part stored raw on disk, or None
+    def replica_range(self, filename, part):
+        return self._file(filename).replica_range(part)
+
+    # Cuts a local file into content-defined chunks for upload. encode
+    # turns a chunk at an offset into what each host stores of it. Returns
+    # [(offset, length, [sha256 of what each host stores])], one per part,
+    # in order
+    def chunk_file(self, filepath, min_size, max_size, encode):
+        with open(filepath, "rb") as file:
+            return [(offset, len(data), [cdc.digest(piece) for piece in encode(offset, data)])
+                    for offset, data in cdc.chunks(file, min_size, max_size)]
+
+    # Reads the given parts of a local file, in order and in one pass over
+    # it, yielding (part, data) a chunk at a time. chunks is as returned by
+    # chunk_file
+    def read_chunks(self, filepath, chunks, parts):
+        with open(filepath, "rb") as file:
+            for part in parts:
+                offset, length, digest = chunks[part - 1]
+                file.seek(offset)
+                yield part, file.read(length)
 
-    def read_from_file(self, filepath):
+    # Reads length bytes of a local file from offset
+    def read_chunk(self, filepath, offset, length):
+        with open(filepath, "rb") as file:
+            file.seek(offset)
+            return file.read(length)
+
+    # Takes a replica's manifest (its chunk digests, in part order, and
+    # which shard it is if the file is erasure coded). Parts whose chunks we
+    # already hold are recorded as stored on the spot. Returns the parts
+    # that still have to be sent.
+    def receive_manifest(self, filename, total, digests, coding = None):
+        self.add_file(filename, total)
+        return self._files[filename].adopt(digests, coding)
+
+    # (shard index, k, m) if our replica of filename is an erasure coded
+    # shard, else None
+    def coding(self, filename):
+        return self._file(filename).coding()
+
+    # (chunks stored, bytes stored, bytes saved by deduplication)
+    def chunk_stats(self):
+        return self._chunks.stats()
+
+    # Bytes free on the disk replicas are kept on
+    def free_space(self):
+        return disk_usage("replicas/").free
+
+    def file_size(self, filepath):
         try:
-            with open(filepath, "r") as file:
-                return file.read()
-        except FileNotFoundError:
+            return path.getsize(filepath)
+        except OSError:
             return False
 
+    # Number of parts in a stored replica
+    def get_total(self, filename):
+        return self._file(filename).get_total()
+
+    def has_part(self, filename, part):
+        if filename not in self._files and filename not in self._stored:
+            return False
+        return self._file(filename).has_part(part)
+
     def remove(self, filename):
-        self._files[filename].remove()
+        self._file(filename).remove()
         del self._files[filename]
-
-    def get_parts(self, filename):
-        return self._files[filename].get_parts()
+        makedirs(self.CHUNKS, exist_ok=True)
+        open(self.GARBAGE, "a").close()
 
     def set_path(self, filename, path):
         self.add_file(filename)
         self._files[filename].set_path(path)
+
+    # Drops the chunks no manifest refers to
+    def _collect(self):
+        live = set()
+        for filename in self._stored:
+            live |= Manifest("replicas/" + filename).digests()
+        self._chunks.compact(live)
+        remove(self.GARBAGE)
@@ -0,0 +1,64 @@
+## Replica placement by availability
+##
+## A peer's availability is the share of heartbeat rounds it was up for, as
+## the network has seen it, with recent rounds counting more. A file's
+## priority sets the probability it should stay reachable with, and a file
+## goes to the fewest peers that get it there: one always-on box can be
+## enough, where a file kept on laptops needs several of them. Peers are
+## taken to go down independently of each other.
+
+# availability assumed for a peer there's no history for yet
+UNKNOWN = 0.5
+
+
+# Probability a file of this priority (0 to 1) should be reachable with:
+# 0.9 at 0, 0.999 at 0.5, 0.99999 at 1
+def target(priority):
+    return 1 - 10 ** -(1 + 4 * priority)
+
+# Probability that at most lost of the peers with these availabilities are
+# down at the same time
+def survival(availabilities, lost):
+    # down[j]: probability that exactly j of the peers so far are down
+    down = [1.0]
+    for availability in availabilities:
+        more = [0.0] * (len(down) + 1)
+        for j, p in enumerate(down):
+            more[j] += p * availability
+            more[j + 1] += p * (1 - availability)
+        down = more
+    return sum(down[:lost + 1])
+
+# Probability a file on peers with these availabilities can be read. Full
+# replicas need one peer up; erasure coded with parity shards per part (see
+# DFSManager._compute_coding) need all but parity of them
+def reachable(availabilities, parity = 0):
+    if not availabilities:
+        return 0.0
+    if parity and len(availabilities) > parity:
+        return survival(availabilities, parity)
+    return survival(availabilities, len(availabilities) - 1)
+
+# Picks the fewest peers that keep a file of size bytes reachable with
+# probability goal. candidates are (peer, availability, free bytes), free
+# bytes None when the peer hasn't said. Returns (peers, probability); when
+# no set reaches goal, the set that comes closest.
+def choose(candidates, size, goal, parity = 0):
+    ranked = sorted(candidates, key=lambda candidate: (-candidate[1], -(candidate[2] or 0)))
+    best = [], 0.0
+
+    for count in range(1, len(ranked) + 1):
+        # a peer stores the whole file, or one shard of every part
+        coded = parity and count > parity
+        need = -(-size // (count - parity)) if coded else size
+        fits = [candidate for candidate in ranked if candidate[2] is None or candidate[2] >= need][:count]
+        if len(fits) < count:
+            continue
+
+        probability = reachable([availability for peer, availability, free in fits], parity)
+        if probability > best[1]:
+            best = [peer for peer, availability, free in fits], probability
+        if probability >= goal:
+            break
+
+    return best
@@ -0,0 +1,46 @@
+from threading import Condition, Lock
+
+# Reader-writer lock. Any number of readers share it, a writer has it to
+# itself. Writers go first: once one is waiting, new readers queue behind
+# it, so a steady stream of lookups can't starve changes. Not reentrant.
+#
+# acquire()/release() are the writer side, so the lock drops in where a
+# plain Lock was used for writers.
+#
+# Soft state:
+#   _readers: readers holding the lock
+#   _writer: a writer holds the lock
+#   _waiting: writers waiting for it
+#   _cond: guards all of the above
+class RWLock:
+
+    def __init__(self):
+        self._readers = 0
+        self._writer = False
+        self._waiting = 0
+        self._cond = Condition(Lock())
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire(self):
+        with self._cond:
+            self._waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = True
+
+    def release(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
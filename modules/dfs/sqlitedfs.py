@@ -0,0 +1,374 @@
+# DFS API on SQLite
+# Same interface as dfs.DFS, for catalogs too big to keep in memory: the
+# file table lives in a database, nothing is loaded at startup and memory
+# doesn't grow with the number of files.
+#
+# class instance soft state:
+#  _db_name: database file name
+#  _db: connection, shared by all threads under _lock
+#  _buckets: digest of each bucket of the file table (see dfs.DFS.digest),
+#            as of the last change that went through
+#  _pending: bucket -> digest for the change being made, folded into
+#            _buckets once the change's savepoint is released
+#  _UPDATE_PERIOD: changes per commit when there is no flusher
+#  _current_update: changes since the last commit
+#  _flusher: commits in the background when given a flush_interval, so a
+#            burst of changes is one transaction. None to commit inline
+#  _lock: thread safety lock
+#
+# Tables:
+#  files: seq (insertion order), filename, uploader, bucket
+#  replicas: file (files.seq), replica, in the order they were added
+#  buckets: bucket, digest (hex, since digests are unsigned 64 bit)
+
+import json                 # importing dfs.json
+import sqlite3              # _db
+from threading import Lock  # _lock
+from modules.dfs.dfs import bucket_of, entry_hash, DFSIOError, DFSAddFileError, \
+    DFSAddReplicaError, DFSRemoveFileError
+from modules.flusher.flusher import Flusher  # _flusher
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    uploader TEXT NOT NULL,
+    bucket   INTEGER NOT NULL,
+    UNIQUE (filename, uploader));
+CREATE INDEX IF NOT EXISTS files_by_bucket ON files (bucket);
+CREATE TABLE IF NOT EXISTS replicas (
+    file    INTEGER NOT NULL,
+    replica TEXT NOT NULL,
+    UNIQUE (file, replica));
+CREATE INDEX IF NOT EXISTS replicas_by_host ON replicas (replica);
+CREATE TABLE IF NOT EXISTS buckets (
+    bucket INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL);
+"""
+
+###########################
+## SQLiteDFS Class
+###########################
+class SQLiteDFS:
+
+    BUCKETS = 256
+
+    # Opens (or creates) the database. A new database is filled from the
+    # json file table at import_from, if there is one.
+    def __init__(self, db_name = None, update_period = 1, flush_interval = None,
+                 import_from = None):
+        self._UPDATE_PERIOD = update_period
+        self._current_update = 0
+        self._db_name = db_name if db_name else "dfs.db"
+        self._lock = Lock()
+        self._flusher = None
+
+        try:
+            # autocommit off: changes pile up in one transaction until _commit
+            self._db = sqlite3.connect(self._db_name, check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SCHEMA)
+            self._db.execute("BEGIN")
+        except sqlite3.Error as e:
+            raise DFSIOError(e)
+
+        self._pending = {}
+        self._load_buckets()
+
+        if import_from and not self._count():
+            self._import(import_from)
+
+        if flush_interval is not None:
+            self._flusher = Flusher(self._commit_locked, flush_interval)
+
+
+    def clear_files(self):
+        def clear():
+            self._db.execute("DELETE FROM files")
+            self._db.execute("DELETE FROM replicas")
+            self._db.execute("DELETE FROM buckets")
+            self._pending = dict.fromkeys(range(self.BUCKETS), 0)
+
+        self._lock.acquire()
+        try:
+            self._change(clear)
+            self._update(True)
+        finally:
+            self._lock.release()
+        self.flush()
+
+    def check_file(self, filename, uploader):
+        self._lock.acquire()
+        try:
+            return self._seq(filename, uploader) is not None
+        finally:
+            self._lock.release()
+
+    # Adds replica for given file
+    def add_replicas(self, filename, replicas):
+        if not isinstance(replicas, list):
+            replicas = [replicas]
+
+        def add():
+            row = self._db.execute("SELECT seq, uploader FROM files WHERE filename = ? "
+                                   "ORDER BY seq LIMIT 1", (filename,)).fetchone()
+            if not row:
+                raise DFSAddReplicaError(filename, "", str(replicas), "\nno such file")
+
+            seq, uploader = row
+            old = self._file(seq, filename, uploader)
+            new = [repl for repl in dict.fromkeys(replicas) if repl not in old["replicas"]]
+            if new:
+                self._db.executemany("INSERT INTO replicas (file, replica) VALUES (?, ?)",
+                                     [(seq, repl) for repl in new])
+                file = dict(old)
+                file["replicas"] = old["replicas"] + new
+                self._rehash(old, file)
+            return bool(new)
+
+        self._lock.acquire()
+        try:
+            if self._change(add):
+                self._update()
+        finally:
+            self._lock.release()
+
+    # Adds file object
+    def add_file(self, filename, uploader, replicas = []):
+        def add():
+            if self._seq(filename, uploader) is not None:
+                raise DFSAddFileError(filename, uploader)
+            self._insert(filename, uploader, replicas)
+
+        self._lock.acquire()
+        try:
+            self._change(add)
+            self._update()
+        finally:
+            self._lock.release()
+
+    def get_file(self, filename):
+        self._lock.acquire()
+        try:
+            row = self._db.execute("SELECT seq, uploader FROM files WHERE filename = ? "
+                                   "ORDER BY seq LIMIT 1", (filename,)).fetchone()
+            return self._file(row[0], filename, row[1]) if row else None
+        finally:
+            self._lock.release()
+
+    # Removes every file called filename
+    def delete_file(self, filename):
+        def delete():
+            rows = self._db.execute("SELECT seq, uploader FROM files WHERE filename = ?",
+                                    (filename,)).fetchall()
+            if not rows:
+                raise DFSRemoveFileError(filename)
+
+            for seq, uploader in rows:
+                self._rehash(self._file(seq, filename, uploader), None)
+                self._db.execute("DELETE FROM replicas WHERE file = ?", (seq,))
+                self._db.execute("DELETE FROM files WHERE seq = ?", (seq,))
+
+        self._lock.acquire()
+        try:
+            self._change(delete)
+            self._update()
+        finally:
+            self._lock.release()
+
+    # returns the DFS
+    def return_log(self):
+        return {"files" : self.list_files()}
+
+    # Returns list of files, in the order they were added
+    def list_files(self):
+        return self._select("")
+
+    def list_files_ref(self):
+        return self.list_files()
+
+    # See dfs.DFS.digest
+    def digest(self):
+        return ["%016x" % bucket for bucket in self._buckets]
+
+    def files_in_buckets(self, buckets):
+        buckets = list(buckets)
+        if not buckets:
+            return []
+        return self._select("WHERE f.bucket IN (%s)" % ",".join("?" * len(buckets)), buckets)
+
+    # Indices of the buckets where digest differs from ours
+    def diff_digest(self, digest):
+        mine = self.digest()
+        if len(digest) != len(mine):
+            return list(range(self.BUCKETS))
+        return [i for i in range(self.BUCKETS) if digest[i] != mine[i]]
+
+    # Forces a commit
+    def update_disk(self):
+        if self._flusher:
+            self._flusher.mark_dirty()
+            self._flusher.flush()
+            return
+        self._lock.acquire()
+        try:
+            self._update(True)
+        finally:
+            self._lock.release()
+
+    # Returns once every change so far is committed
+    def flush(self):
+        if self._flusher:
+            self._flusher.flush()
+
+    # (changes, commits, commits saved by batching), None without a flusher
+    def flush_stats(self):
+        if not self._flusher:
+            return None
+        changes, writes, errors = self._flusher.stats()
+        return changes, writes, self._flusher.coalesced()
+
+    # Counts a change and commits every _UPDATE_PERIOD of them, or leaves
+    # it to the flusher. Called under _lock.
+    def _update(self, toFile=False):
+        if self._flusher:
+            self._flusher.mark_dirty()
+            return
+
+        if not toFile:
+            self._current_update += 1
+        if self._current_update < self._UPDATE_PERIOD and not toFile:
+            return
+
+        self._commit()
+        self._current_update = self._current_update if toFile else 0
+
+    # Makes one change to the tables: change() runs in a savepoint inside
+    # the open transaction, so if it fails its writes are undone and
+    # _buckets never see it. Returns what change() returns. Called under
+    # _lock.
+    def _change(self, change):
+        self._pending = {}
+        try:
+            self._db.execute("SAVEPOINT change")
+        except sqlite3.Error as e:
+            raise DFSIOError(e)
+
+        try:
+            result = change()
+            self._db.execute("RELEASE change")
+        except BaseException as e:
+            try:
+                self._db.execute("ROLLBACK TO change")
+                self._db.execute("RELEASE change")
+            except sqlite3.Error:
+                # the whole transaction went; the table is as last committed
+                self._reopen()
+            if isinstance(e, sqlite3.Error):
+                raise DFSIOError(e)
+            raise
+
+        for bucket, digest in self._pending.items():
+            self._buckets[bucket] = digest
+        return result
+
+    def _commit(self):
+        try:
+            self._db.execute("COMMIT")
+            self._db.execute("BEGIN")
+        except sqlite3.Error as e:
+            # a commit that fails can take the transaction with it
+            if not self._db.in_transaction:
+                self._reopen()
+            raise DFSIOError(e)
+
+    # Starts a new transaction after SQLite dropped the old one, and reads
+    # _buckets back from what is committed
+    def _reopen(self):
+        if not self._db.in_transaction:
+            self._db.execute("BEGIN")
+        self._load_buckets()
+
+    def _load_buckets(self):
+        self._buckets = [0] * self.BUCKETS
+        for bucket, digest in self._db.execute("SELECT bucket, digest FROM buckets"):
+            self._buckets[bucket] = int(digest, 16)
+
+    # Flusher's write
+    def _commit_locked(self):
+        self._lock.acquire()
+        try:
+            self._commit()
+        finally:
+            self._lock.release()
+
+    def _insert(self, filename, uploader, replicas):
+        replicas = list(dict.fromkeys(replicas))
+        cursor = self._db.execute("INSERT INTO files (filename, uploader, bucket) VALUES (?, ?, ?)",
+                                  (filename, uploader, bucket_of(filename, uploader, self.BUCKETS)))
+        self._db.executemany("INSERT INTO replicas (file, replica) VALUES (?, ?)",
+                             [(cursor.lastrowid, repl) for repl in replicas])
+        self._rehash(None, {"filename" : filename, "uploader" : uploader, "replicas" : replicas})
+
+    # Swaps old's hash for new's in their bucket digest (either may be
+    # None). The new digest waits in _pending until the change goes through
+    def _rehash(self, old, new):
+        f = old if old else new
+        bucket = bucket_of(f["filename"], f["uploader"], self.BUCKETS)
+        digest = self._pending.get(bucket, self._buckets[bucket])
+        for entry in (old, new):
+            if entry:
+                digest ^= entry_hash(entry)
+        self._pending[bucket] = digest
+        self._db.execute("INSERT OR REPLACE INTO buckets (bucket, digest) VALUES (?, ?)",
+                         (bucket, "%016x" % digest))
+
+    def _seq(self, filename, uploader):
+        row = self._db.execute("SELECT seq FROM files WHERE filename = ? AND uploader = ?",
+                               (filename, uploader)).fetchone()
+        return row[0] if row else None
+
+    def _file(self, seq, filename, uploader):
+        replicas = [row[0] for row in self._db.execute(
+            "SELECT replica FROM replicas WHERE file = ? ORDER BY rowid", (seq,))]
+        return {"filename" : filename, "replicas" : replicas, "uploader" : uploader}
+
+    # File objects for the files matching where, in one pass over a join
+    def _select(self, where, args = ()):
+        self._lock.acquire()
+        try:
+            files = {}
+            for seq, filename, uploader, replica in self._db.execute(
+                    "SELECT f.seq, f.filename, f.uploader, r.replica FROM files f "
+                    "LEFT JOIN replicas r ON r.file = f.seq " + where +
+                    " ORDER BY f.seq, r.rowid", args):
+                if seq not in files:
+                    files[seq] = {"filename" : filename, "replicas" : [], "uploader" : uploader}
+                if replica is not None:
+                    files[seq]["replicas"].append(replica)
+            return list(files.values())
+        finally:
+            self._lock.release()
+
+    def _count(self):
+        return self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    # Fills an empty database from a dfs.DFS json file, in one transaction
+    def _import(self, json_name):
+        try:
+            with open(json_name, 'r') as file:
+                files = json.load(file)["files"]
+        except FileNotFoundError:
+            return
+        except (IOError, ValueError) as e:
+            raise DFSIOError(e)
+
+        def fill():
+            for f in files:
+                if self._seq(f["filename"], f["uploader"]) is None:
+                    self._insert(f["filename"], f["uploader"], f["replicas"])
+
+        self._change(fill)
+        self._commit()
@@ -0,0 +1,341 @@
+## Transfer bookkeeping for chunked uploads and downloads
+##
+## Files move as numbered parts (1..total). Each side keeps a bounded window
+## of parts that are in flight; a part that is not answered in time is sent
+## (or requested) again on its own, so a failure costs one part, not the file.
+
+import time
+from threading import Condition, Event, Lock
+
+# Parts sent to (or requested from) one peer that have not been answered yet.
+# Soft state:
+#  _size: max parts in flight
+#  _timeout: seconds before an unanswered part counts as lost
+#  _pending: part -> time it went out
+#  _cond: guards _pending, notified on every answer (may be shared by
+#         several windows so one waiter hears about all of them)
+class Window:
+
+    def __init__(self, size, timeout, cond = None):
+        self._size = size
+        self._timeout = timeout
+        self._pending = {}
+        self._cond = cond if cond else Condition()
+
+    def resize(self, size):
+        with self._cond:
+            self._size = size
+
+    def has_room(self):
+        with self._cond:
+            return len(self._pending) < self._size
+
+    def in_flight(self):
+        with self._cond:
+            return len(self._pending)
+
+    def sent(self, part):
+        with self._cond:
+            self._pending[part] = time.time()
+
+    # Returns how long the part was out, or None if it was not outstanding
+    def answered(self, part):
+        with self._cond:
+            sent = self._pending.pop(part, None)
+            if sent is None:
+                return None
+            self._cond.notify_all()
+            return time.time() - sent
+
+    def pending(self):
+        with self._cond:
+            return list(self._pending.keys())
+
+    # Drops and returns the parts that have been out longer than the timeout
+    def expired(self):
+        now = time.time()
+        with self._cond:
+            lost = [part for part, sent in self._pending.items() if now - sent > self._timeout]
+            for part in lost:
+                del self._pending[part]
+            return lost
+
+    # Sleeps until something is answered or timeout passes
+    def wait(self, timeout):
+        with self._cond:
+            self._cond.wait(timeout)
+
+
+# Sender side of one file going to one replica host
+# Soft state:
+#  filename, host: what goes where
+#  total: number of parts
+#  shard: which of what the uploader makes of each part the host stores
+#         (its erasure coded shard, or 0 for the whole part)
+#  window: parts waiting for a HAVE_REPLICA
+#  _todo: parts still to send, in order
+#  _retries: part -> times it was resent
+#  _needed: parts the host asked for after seeing the manifest
+#  _answered: set once the host has answered the manifest
+class Upload:
+
+    def __init__(self, filename, host, total, window, timeout):
+        self.filename = filename
+        self.host = host
+        self.total = total
+        self.shard = 0
+        self.window = Window(window, timeout)
+        self._todo = list(range(total, 0, -1))
+        self._retries = {}
+        self._needed = None
+        self._answered = Event()
+
+    # The host's answer to the manifest: the parts it doesn't have yet
+    def need(self, parts):
+        self._needed = parts
+        self._answered.set()
+
+    # Waits up to timeout for the answer to the manifest, after which only
+    # the parts the host needs are sent. Without an answer all of them are.
+    def await_needs(self, timeout):
+        if not self._answered.wait(timeout):
+            return False
+        self._todo = sorted(self._needed, reverse=True)
+        return True
+
+    # Parts not sent yet
+    def remaining(self):
+        return len(self._todo)
+
+    def unsent(self):
+        return list(self._todo)
+
+    # Next part to send, or None if everything is out
+    def next_part(self):
+        return self._todo.pop() if self._todo else None
+
+    # next_part() without taking it
+    def peek(self):
+        return self._todo[-1] if self._todo else None
+
+    # Puts lost parts back at the front of the queue. Returns False once
+    # a part has been retried more than max_retries times.
+    def requeue(self, parts, max_retries):
+        for part in parts:
+            self._retries[part] = self._retries.get(part, 0) + 1
+            if self._retries[part] > max_retries:
+                return False
+            self._todo.append(part)
+        return True
+
+    def done(self):
+        return not self._todo and not self.window.in_flight()
+
+
+# One replica host serving parts of a download
+# Soft state:
+#  host: where parts are requested from
+#  window: parts requested from this host and not yet received
+#  rate: smoothed bytes/sec seen from this host (None until the first part)
+#  stalls: parts lost on this host in a row
+class Source:
+
+    SMOOTHING = 0.3
+
+    def __init__(self, host, window, timeout, cond):
+        self.host = host
+        self.window = Window(window, timeout, cond)
+        self.rate = None
+        self.stalls = 0
+
+    def record(self, size, elapsed):
+        sample = size / max(elapsed, 0.001)
+        self.rate = sample if self.rate is None else \
+            (1 - self.SMOOTHING) * self.rate + self.SMOOTHING * sample
+        self.stalls = 0
+
+    def stalled(self):
+        self.stalls += 1
+        if self.rate is not None:
+            self.rate /= 2
+
+
+# Receiver side of one file, spread over every replica host that is online.
+# The total is learned from the first slice. Each source gets a window sized
+# to its share of the observed throughput, and parts that stall on one source
+# go back in the queue for whichever source has room next.
+#
+# Parts of an erasure coded file take pieces answers each, from different
+# hosts, since every host holds its own shard of every part. A part stays
+# at the front of the queue until enough hosts have been asked for it.
+# Soft state:
+#  filename: file being downloaded
+#  total: number of parts (None until known)
+#  pieces: answers from different hosts a part takes (1 unless coded)
+#  sources: host -> Source
+#  _max_window: window of the fastest source
+#  _received: parts already written
+#  _todo: parts never requested (or lost, or short of hosts), in order
+#  _retries: part -> times it was requested again
+#  _asked: part -> hosts it was requested from
+#  _out: part -> requests for it not yet answered or lost
+#  _got: part -> hosts that answered it
+#  _cond: shared by all source windows, notified when any part arrives
+#  _lock: slices arrive on listener threads while the scheduler runs
+class Download:
+
+    def __init__(self, filename, hosts, window, timeout):
+        self.filename = filename
+        self.total = None
+        self.pieces = 1
+        self._max_window = window
+        self._cond = Condition()
+        self.sources = {host: Source(host, window, timeout, self._cond) for host in hosts}
+        self._received = set()
+        self._todo = [1]
+        self._retries = {}
+        self._asked = {}
+        self._out = {}
+        self._got = {}
+        self._lock = Lock()
+
+    # Starts from the parts an earlier attempt already received
+    def resume(self, parts, total):
+        with self._lock:
+            self.total = total
+            self._received = set(parts)
+            self._todo = [part for part in range(total, 0, -1) if part not in self._received]
+
+    # Makes every part take pieces answers from different hosts. Parts
+    # asked of fewer hosts go back in the queue
+    def set_pieces(self, pieces):
+        with self._lock:
+            if pieces == self.pieces:
+                return
+            self.pieces = pieces
+            for part in set(self._out) | set(self._got):
+                if part not in self._received and part not in self._todo and self._short(part):
+                    self._todo.append(part)
+
+    # Records an arriving part from host. Returns True once the part is
+    # complete, False for duplicates and for pieces short of that
+    def received(self, part, total, size, host):
+        elapsed = None
+        source = self.sources.get(host)
+        if source:
+            elapsed = source.window.answered(part)
+            if elapsed is not None:
+                source.record(size, elapsed)
+
+        with self._lock:
+            if elapsed is not None:
+                self._out[part] = self._out.get(part, 1) - 1
+            if part in self._received:
+                return False
+
+            if self.total is None:
+                self.total = total
+                self._todo = [p for p in range(total, 0, -1) if p not in self._received and p != part]
+                if self.pieces > 1:
+                    self._todo.append(part)
+
+            self._got.setdefault(part, set()).add(host)
+            if len(self._got[part]) < self.pieces:
+                return False
+
+            self._received.add(part)
+            for table in [self._asked, self._out, self._got]:
+                table.pop(part, None)
+            return True
+
+    def has_part(self, part):
+        with self._lock:
+            return part in self._received
+
+    # Collects parts that timed out on each source and queues them again.
+    # Returns False once a part has failed max_retries times on every source.
+    def reassign_stalled(self, max_retries):
+        for source in list(self.sources.values()):
+            lost = source.window.expired()
+            if lost:
+                source.stalled()
+                if not self._requeue(lost, max_retries * len(self.sources)):
+                    return False
+        return True
+
+    # Stops using a host, putting its outstanding parts back in the queue
+    def drop_source(self, host):
+        source = self.sources.pop(host, None)
+        if source:
+            self._requeue(source.window.pending(), None)
+
+    # Sizes every source window to its share of the total throughput:
+    # the fastest source gets the full window, others proportionally less.
+    # Sources with no measurement yet get the full window to get one.
+    def rebalance(self):
+        rates = [source.rate for source in self.sources.values() if source.rate]
+        fastest = max(rates) if rates else None
+        for source in self.sources.values():
+            if fastest and source.rate:
+                share = source.rate / fastest
+                source.window.resize(max(1, int(round(self._max_window * share))))
+            else:
+                source.window.resize(self._max_window)
+
+    # Sources ordered fastest first
+    def ranked_sources(self):
+        return sorted(self.sources.values(), key=lambda source: -(source.rate or 0))
+
+    # Next part to request from host, or None if there's nothing it can
+    # be asked for
+    def next_part(self, host = None):
+        with self._lock:
+            part = None
+            skipped = []
+            while self._todo and part is None:
+                candidate = self._todo.pop()
+                if candidate in self._received:
+                    continue
+                if self.pieces > 1:
+                    # a host has one shard of a part, so it is asked once
+                    if not self._short(candidate):
+                        continue
+                    if host in self._asked.get(candidate, ()):
+                        skipped.append(candidate)
+                        continue
+                part = candidate
+
+            if part is not None:
+                self._asked.setdefault(part, set()).add(host)
+                self._out[part] = self._out.get(part, 0) + 1
+                if self.pieces > 1 and self._short(part):
+                    self._todo.append(part)
+
+            # parts skipped for this host stay first in line for the next
+            self._todo.extend(reversed(skipped))
+            return part
+
+    # The part is asked of too few hosts to complete. Called under _lock
+    def _short(self, part):
+        return len(self._got.get(part, ())) + self._out.get(part, 0) < self.pieces
+
+    def _requeue(self, parts, max_retries):
+        with self._lock:
+            for part in parts:
+                if part in self._received:
+                    continue
+                self._out[part] = max(self._out.get(part, 0) - 1, 0)
+                self._retries[part] = self._retries.get(part, 0) + 1
+                if max_retries is not None and self._retries[part] > max_retries:
+                    return False
+                self._todo.append(part)
+            return True
+
+    # Sleeps until any part arrives or timeout passes
+    def wait(self, timeout):
+        with self._cond:
+            self._cond.wait(timeout)
+
+    def done(self):
+        with self._lock:
+            return self.total is not None and len(self._received) == self.total
@@ -0,0 +1,161 @@
+import time
+from threading import Condition, Thread
+
+# Group commit for state that lives in memory and is mirrored to a file.
+#
+# Owners call mark_dirty() after each change instead of writing the file
+# themselves. A background thread calls write() once the oldest unwritten
+# change is interval seconds old, or as soon as batch changes pile up, so a
+# burst of changes costs one write. write() must take its own snapshot of
+# the state (under the owner's lock) and do the file i/o outside it.
+#
+# Soft state:
+#   _write: writes the owner's current state out
+#   _interval: longest a change waits before it is written
+#   _batch: changes that trigger a write before the interval is up
+#   _marked: changes marked so far
+#   _written: changes known to be on disk (value of _marked at the last write)
+#   _since: time of the oldest unwritten change, None when clean
+#   _forced: a flush() is waiting, write now
+#   _writes: writes that went through
+#   _errors: writes that failed
+#   _error: exception of the last failed write
+#   _failures: failed writes in a row
+#   _retry_at: when to try again after a failed write (sooner if forced)
+#   _closed: set by close(); the thread writes what is left and stops
+#   _cond: guards all of the above
+class Flusher:
+
+    INTERVAL = 1
+    BATCH    = 100
+
+    # after n failed writes in a row the next try waits
+    # RETRY_BASE * 2^(n - 1) seconds, at most RETRY_MAX
+    RETRY_BASE = 1
+    RETRY_MAX  = 60
+
+    def __init__(self, write, interval = INTERVAL, batch = BATCH):
+        self._write = write
+        self._interval = interval
+        self._batch = batch
+
+        self._marked = 0
+        self._written = 0
+        self._since = None
+        self._forced = False
+        self._writes = 0
+        self._errors = 0
+        self._error = None
+        self._failures = 0
+        self._retry_at = 0
+        self._closed = False
+        self._cond = Condition()
+
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # Notes that the state changed and needs writing
+    def mark_dirty(self):
+        with self._cond:
+            self._marked += 1
+            if self._since is None:
+                self._since = time.time()
+            self._cond.notify_all()
+
+    # Barrier: returns once every change marked before the call is written.
+    # Raises FlushError if a write tried after the call fails
+    def flush(self):
+        with self._cond:
+            target = self._marked
+            if self._written >= target:
+                return
+            errors = self._errors
+            self._forced = True
+            self._cond.notify_all()
+            while self._written < target and self._thread.is_alive():
+                if self._errors > errors:
+                    raise FlushError(str(self._error))
+                self._cond.wait()
+
+    # Writes what is left and stops the thread. Raises FlushError if that
+    # write fails; the thread stops all the same
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._thread.join()
+
+    # (changes marked, writes done, writes failed)
+    def stats(self):
+        with self._cond:
+            return self._marked, self._writes, self._errors
+
+    # Changes that were folded into someone else's write
+    def coalesced(self):
+        with self._cond:
+            return self._written - self._writes
+
+    def _due(self):
+        pending = self._marked - self._written
+        if not pending:
+            return False
+        if self._forced or self._closed:
+            return True
+        if self._failures:
+            return time.time() >= self._retry_at
+        return pending >= self._batch or time.time() - self._since >= self._interval
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    if self._closed:
+                        return
+                    timeout = None
+                    if self._failures:
+                        timeout = max(0, self._retry_at - time.time())
+                    elif self._since is not None:
+                        timeout = max(0, self._since + self._interval - time.time())
+                    self._cond.wait(timeout)
+                target = self._marked
+                since = self._since
+                self._since = None
+                self._forced = False
+
+            # a failed write leaves the file as it was and the changes
+            # unwritten; they are tried again, with the whole state, after a
+            # backoff or as soon as someone flushes
+            error = None
+            try:
+                self._write()
+            except Exception as e:
+                error = e
+                print("Flusher: write failed. Exception: " + str(e))
+
+            with self._cond:
+                if error is None:
+                    self._writes += 1
+                    self._written = target
+                    self._failures = 0
+                    self._retry_at = 0
+                else:
+                    self._errors += 1
+                    self._error = error
+                    self._failures += 1
+                    self._retry_at = time.time() + min(self.RETRY_MAX, self.RETRY_BASE * 2 ** (self._failures - 1))
+                    if self._since is None:
+                        self._since = since
+                self._cond.notify_all()
+                if error is not None and self._closed:
+                    return
+
+
+###########################
+## Flusher Exceptions
+###########################
+class FlushError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, "Flush failed: " + msg)
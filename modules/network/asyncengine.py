@@ -0,0 +1,170 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .message import Message, MessageFormatError
+from modules.logger.log import Log
+
+# Optional asyncio networking engine. One event loop (on its own thread)
+# accepts connections, reads frames from every peer and runs the periodic
+# tasks, instead of one OS thread per socket.
+#
+# Message handlers are the same blocking functions the threaded engine uses.
+# They run on a small worker pool, one frame at a time per connection, so
+# a connection still sees its frames handled in order and handlers are free
+# to send, connect or touch disk without stalling the loop.
+#
+# Outgoing frames are sent from the loop too: each connection's SendQueue
+# lanes are drained by a task rather than a writer thread per socket.
+#
+# Soft state:
+#   _loop: the event loop
+#   _thread: thread running the loop
+#   _executor: worker pool for handlers and periodic jobs
+#   _servers: listening servers started by serve()
+class AsyncEngine:
+
+    WORKERS = 16
+
+    def __init__(self, workers = WORKERS):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._servers = []
+
+        log = Log()
+        self._logger = log.get_logger()
+
+    def start(self):
+        self._thread.start()
+
+    # Starts accepting connections on (host, port).
+    #   on_frame(frame, host, state) -> True when the connection should die
+    #   on_close(host) is called once a connection is dropped
+    # state is a dict private to the connection, shared by its frames.
+    def serve(self, host, port, on_frame, on_close):
+        async def start():
+            handler = lambda reader, writer: self._serve_connection(reader, writer, on_frame, on_close)
+            server = await asyncio.start_server(handler, host, port, reuse_address=True)
+            self._servers.append(server)
+        self._call(start())
+
+    # Opens an outgoing connection. Blocks the calling thread (never the loop)
+    # and returns a StreamConnection to hand to drain.
+    def connect(self, host, port, timeout):
+        async def open():
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            return StreamConnection(self._loop, writer)
+        return self._call(open())
+
+    # Runs job on the worker pool every period seconds
+    def every(self, period, job):
+        async def repeat():
+            while True:
+                await asyncio.sleep(period)
+                try:
+                    await self._loop.run_in_executor(self._executor, job)
+                except Exception as e:
+                    self._logger.error("AsyncEngine: periodic job failed: %s" % (e))
+        self._loop.call_soon_threadsafe(self._loop.create_task, repeat())
+
+    # Sends everything queue hands out for the given lanes on conn (a
+    # StreamConnection from connect) from the loop, in place of a writer
+    # thread. on_error(err) runs on the worker pool if a send fails.
+    def drain(self, queue, conn, control, bulk, on_error):
+        async def run():
+            wake = asyncio.Event()
+            queue.watch(lambda: self._loop.call_soon_threadsafe(wake.set))
+            while True:
+                wake.clear()
+                item = queue.poll(control, bulk)
+                if item is None:
+                    if queue.closed():
+                        return
+                    await wake.wait()
+                    continue
+
+                buffers, range = item
+                try:
+                    await conn.send(buffers, range)
+                except Exception as e:
+                    if not queue.closed():
+                        self._logger.info("AsyncEngine: send failed: %s" % (e))
+                        await self._loop.run_in_executor(self._executor, on_error, e)
+                    return
+        self._loop.call_soon_threadsafe(self._loop.create_task, run())
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    # Runs a coroutine on the loop from another thread and waits for it
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _serve_connection(self, reader, writer, on_frame, on_close):
+        host = writer.get_extra_info("peername")[0]
+        self._logger.info("Contacted by node at " + str(host))
+
+        state = {}
+        try:
+            while True:
+                try:
+                    frame = await self._read_frame(reader)
+                except (OSError, asyncio.IncompleteReadError, MessageFormatError) as e:
+                    self._logger.info("AsyncEngine: bad frame from %s: %s" % (host, e))
+                    frame = None
+
+                time_to_die = await self._loop.run_in_executor(self._executor, on_frame, frame, host, state)
+                if time_to_die or frame is None:
+                    break
+        finally:
+            await self._loop.run_in_executor(self._executor, on_close, host)
+            writer.close()
+
+    # Reads one whole frame. Returns (tag, fields), or None on a clean close
+    async def _read_frame(self, reader):
+        try:
+            header = await reader.readexactly(Message.HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+
+        tag, flags, count, length = Message.parse_header(header)
+        lengths = Message.parse_field_table(await reader.readexactly(Message.table_size(count)), count)
+        payload = await reader.readexactly(length)
+        return tag, Message.unpack_payload(flags, memoryview(payload), lengths)
+
+
+# Outgoing connection opened by the engine. Node hands it to drain, which
+# sends on it from the loop; close works from any thread.
+class StreamConnection:
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+
+    def close(self):
+        if self._on_loop():
+            self._writer.close()
+        else:
+            self._loop.call_soon_threadsafe(self._writer.close)
+
+    # Sends buffers, then count bytes at offset of the file at path if range
+    # is (path, offset, count). Runs on the loop
+    async def send(self, buffers, range = None):
+        for buf in buffers:
+            self._writer.write(buf)
+        if range:
+            path, offset, count = range
+            with open(path, "rb") as file:
+                sent = await self._loop.sendfile(self._writer.transport, file, offset, count)
+            if sent != count:
+                raise OSError("file ended %d bytes into a %d byte range" % (sent, count))
+        await self._writer.drain()
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
@@ -0,0 +1,69 @@
+import zlib
+import lzma
+
+# zstd is optional: the stdlib module on newer pythons, else the zstandard package
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    zstd = None
+
+# Payload compression codecs. A codec's id goes in the frame's flags byte,
+# its name is what peers advertise in the IDENTITY handshake.
+#
+# decompress(data, limit) stops after limit + 1 bytes of output, so a
+# small frame that inflates without end costs no more than that; getting
+# more than limit back means the frame lied about its size.
+#
+# Soft state:
+#   id: flags value marking a frame compressed with this codec (never 0)
+#   name: name advertised to peers
+class Codec:
+
+    def __init__(self, id, name, compress, decompress):
+        self.id = id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _zstd_codec():
+    if zstd:
+        return Codec(3, "zstd", lambda data: zstd.compress(data, 3),
+                     lambda data, limit: zstd.ZstdDecompressor().decompress(data, limit + 1))
+    if zstandard:
+        return Codec(3, "zstd",
+                     lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                     lambda data, limit: zstandard.ZstdDecompressor().stream_reader(data).read(limit + 1))
+    return None
+
+# Preference order: zstd is fast and compresses well, zlib is cheap, lzma
+# squeezes hardest but costs the most cpu.
+_CODECS = [codec for codec in [
+    _zstd_codec(),
+    Codec(1, "zlib", lambda data: zlib.compress(data, 6),
+          lambda data, limit: zlib.decompressobj().decompress(data, limit + 1)),
+    Codec(2, "lzma", lzma.compress,
+          lambda data, limit: lzma.LZMADecompressor().decompress(data, limit + 1)),
+] if codec]
+
+_BY_ID = {codec.id: codec for codec in _CODECS}
+_BY_NAME = {codec.name: codec for codec in _CODECS}
+
+
+# Names of the codecs this node supports, most preferred first
+def available():
+    return [codec.name for codec in _CODECS]
+
+# Picks the codec to send with: the peer's most preferred one that we have
+def choose(peer_names):
+    for name in peer_names:
+        if name in _BY_NAME:
+            return _BY_NAME[name]
+    return None
+
+def by_id(id):
+    return _BY_ID.get(id)
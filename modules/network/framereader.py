@@ -0,0 +1,111 @@
+from .message import Message
+
+# Buffered frame reader for one incoming connection.
+#
+# Reads with recv_into straight into a reusable bytearray and parses every
+# complete frame a read delivered before touching the socket again, so a
+# burst of small control frames costs a single syscall. Payload fields are
+# handed out as memoryviews into the buffer: they are only valid until the
+# next call to next_frame, so copy anything that has to outlive it.
+# Compressed payloads are decompressed into their own buffer.
+#
+# The buffer grows to fit a big frame and goes back to its initial size
+# once that frame has been handed out, so a connection that carried one
+# large part doesn't hold on to its buffer for good.
+#
+# Soft state:
+#   _conn: socket being read
+#   _size: initial buffer size
+#   _buf: receive buffer (replaced, never resized, when it grows or shrinks)
+#   _view: memoryview over _buf
+#   _start: offset of the first unparsed byte
+#   _end: offset one past the last received byte
+class FrameReader:
+
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, conn, size = INITIAL_SIZE):
+        self._conn = conn
+        self._size = size
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    # Returns (tag, fields) for the next frame, or None once the connection closes
+    def next_frame(self):
+        while True:
+            frame = self._parse()
+            if frame:
+                return frame
+            if not self._fill():
+                return None
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    # Tries to cut one complete frame out of the buffered bytes
+    def _parse(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+            self._shrink()
+
+        available = self._end - self._start
+        if available < Message.HEADER.size:
+            self._reserve(Message.HEADER.size)
+            return None
+
+        tag, flags, count, length = Message.parse_header(self._buf, self._start)
+        table_start = self._start + Message.HEADER.size
+        payload_start = table_start + Message.table_size(count)
+        frame_size = payload_start + length - self._start
+        if available < frame_size:
+            self._reserve(frame_size)
+            return None
+
+        lengths = Message.parse_field_table(self._buf, count, table_start)
+        self._start += frame_size
+        payload = self._view[payload_start:payload_start + length]
+        return tag, Message.unpack_payload(flags, payload, lengths)
+
+    # Makes sure a frame of size bytes starting at _start fits in the buffer
+    def _reserve(self, size):
+        if self._start + size <= len(self._buf):
+            return
+
+        pending = self._end - self._start
+        if size > len(self._buf):
+            # Grow into a fresh buffer. Views handed out earlier keep the old
+            # one alive, so they stay intact.
+            new_size = len(self._buf)
+            while new_size < size:
+                new_size *= 2
+            buf = bytearray(new_size)
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        else:
+            # Slide the partial frame to the front
+            self._buf[:pending] = self._buf[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+    # Swaps a grown buffer for one of the initial size. Called only once
+    # everything in it is parsed, never in the middle of a frame. Views
+    # handed out earlier keep the big one alive until they go
+    def _shrink(self):
+        if len(self._buf) > self._size:
+            self._buf = bytearray(self._size)
+            self._view = memoryview(self._buf)
+
+    # One recv_into into the free tail of the buffer. False on close
+    def _fill(self):
+        n = self._conn.recv_into(self._view[self._end:])
+        if not n:
+            return False
+        self._end += n
+        return True
@@ -1,41 +1,193 @@
+import struct
+from . import codec as codecs
+
 # For abstraction of single-byte message headers
+#
+# Wire format (version 1), all integers big-endian:
+#   header:       version (1) | tag (1) | flags (1) | field count (2) | payload length (8)
+#   field table:  one 8-byte length per field
+#   payload:      the fields back to back, no delimiters
+#
+# Fields are bytes end to end. Strings passed in are utf-8 encoded, so any
+# byte (including the old "~" delimiter) is allowed inside a field.
+#
+# A non-zero flags byte is the id of the codec the payload was compressed
+# with. The field table always holds the uncompressed field lengths, the
+# header holds the length actually on the wire.
 class Message:
-    DELIMITER     = "~"
-    LENGTH_SIZE   = 4
-    
+    VERSION       = 1
+
+    HEADER        = struct.Struct("!BcBHQ")
+    FIELD_LENGTH  = struct.Struct("!Q")
+
+    # frames with less payload than this are joined into one buffer before sending
+    SMALL_FRAME   = 64 * 1024
+
+    # payloads smaller than this are never worth compressing
+    COMPRESS_MIN  = 4 * 1024
+
+    # frames claiming more payload than this (on the wire or decompressed)
+    # are refused before anything is allocated for them. Parts are at most
+    # DFSManager.PART_SIZE, so only a broken or hostile peer gets near it
+    MAX_FRAME     = 256 * 1024 * 1024
+
     class Tags:
-        IDENTITY       = "V"    # [id]
-        HEARTBEAT      = "H"    # ["hi"]
-        
+        IDENTITY       = "V"    # [id, codecs]
+        HEARTBEAT      = "H"    # [bytes free for replicas, or "hi"]
+
         HOST_JOINED    = "T"    # [host]
         USER_INFO      = "A"    # [user1, user2, ....]
         DFS_INFO       = "D"    # [dfs_json_str]
+        DFS_DIGEST     = "G"    # [digest_json_str]
         POKE           = "P"    # ["poke"]
 
-        REMOVE_FILE    = "R"
-        UPLOAD_FILE    = "U"    
+        REMOVE_FILE    = "R"    # [name]
+        UPLOAD_FILE    = "U"    # [name, uploader]
+
+        STORE_REPLICA  = "Z"    # [name, uploader, part, total, data]
+        HAVE_REPLICA   = "W"    # [name, uploader, part, total]
+        MANIFEST       = "M"    # [name, uploader, total, sha256 of each part back to back, coding]
+        NEED_PARTS     = "N"    # [name, "part,part,..."]
+
+        REQUEST_FILE   = "S"    # [name, part, total]
+        FILE_SLICE     = "F"    # [name, part, total, offset in file, file size, coding, data]
+
+        # coding is "shard index,k,m" for a shard of an erasure coded file,
+        # empty for a full replica
+
+        # MANIFEST, STORE_REPLICA and FILE_SLICE are bulk frames: they travel
+        # on a peer's data connections, the rest on its control connection.
+        # The two are not ordered relative to each other, nor are the data
+        # connections among themselves, so every bulk frame is either the
+        # first of an exchange or the answer to a control frame (NEED_PARTS,
+        # REQUEST_FILE), and no control frame relies on a bulk frame sent
+        # before it having arrived.
+
+    # Builds a frame for tag and data (a single field or a list of fields).
+    # Returns a list of buffers to be written in order: small frames come back
+    # as one buffer, large ones as the header followed by the untouched fields.
+    # With a codec, payloads of at least COMPRESS_MIN bytes are compressed
+    # unless that does not make them smaller.
+    @classmethod
+    def pack(cls, tag, data, codec = None):
+        if not isinstance(data, list):
+            data = [data]
+
+        fields = [cls._to_bytes(field) for field in data]
+        lengths = [len(field) for field in fields]
+        payload_length = sum(lengths)
+
+        flags = 0
+        if codec and payload_length >= cls.COMPRESS_MIN:
+            packed = codec.compress(b"".join(fields))
+            if len(packed) < payload_length:
+                flags = codec.id
+                fields = [packed]
+                payload_length = len(packed)
+
+        header = cls.HEADER.pack(cls.VERSION, str.encode(tag), flags, len(lengths), payload_length)
+        table = struct.pack("!%dQ" % len(lengths), *lengths)
+
+        if payload_length < cls.SMALL_FRAME:
+            return [b"".join([header, table] + fields)]
+        return [header + table] + fields
+
+    # Builds everything of a frame except its last field, which the caller
+    # writes itself (e.g. straight from a file with sendfile). tail_length is
+    # the size of that last field.
+    @classmethod
+    def pack_head(cls, tag, data, tail_length):
+        fields = [cls._to_bytes(field) for field in data]
+        lengths = [len(field) for field in fields] + [tail_length]
+
+        header = cls.HEADER.pack(cls.VERSION, str.encode(tag), 0, len(lengths), sum(lengths))
+        table = struct.pack("!%dQ" % len(lengths), *lengths)
+        return b"".join([header, table] + fields)
+
+    # Builds a frame as a single bytes object
+    @classmethod
+    def to_bytes(cls, tag, data, codec = None):
+        return b"".join(cls.pack(tag, data, codec))
+
+    # Sizes of a packed frame's payload as (uncompressed, on the wire)
+    @classmethod
+    def payload_sizes(cls, buffers):
+        tag, flags, count, length = cls.parse_header(buffers[0])
+        return sum(cls.parse_field_table(buffers[0], count, cls.HEADER.size)), length
+
+    # Parses a fixed header. Returns (tag, flags, field count, payload length)
+    @classmethod
+    def parse_header(cls, buf, offset = 0):
+        version, tag, flags, count, length = cls.HEADER.unpack_from(buf, offset)
+        if version != cls.VERSION:
+            raise MessageFormatError("unsupported frame version %d" % version)
+        if length > cls.MAX_FRAME:
+            raise MessageFormatError("frame of %d bytes, at most %d" % (length, cls.MAX_FRAME))
+        return bytes.decode(tag), flags, count, length
+
+    # Parses the field table following a header. Returns the list of field lengths
+    @classmethod
+    def parse_field_table(cls, buf, count, offset = 0):
+        return list(struct.unpack_from("!%dQ" % count, buf, offset))
+
+    @classmethod
+    def table_size(cls, count):
+        return count * cls.FIELD_LENGTH.size
+
+    # Turns a received payload into its fields, decompressing it if flags
+    # say so. Uncompressed payloads are cut up without copying. Decompression
+    # stops just past the size the field table declares, so a payload that
+    # inflates further is refused without being inflated.
+    @classmethod
+    def unpack_payload(cls, flags, payload, lengths):
+        if sum(lengths) > cls.MAX_FRAME:
+            raise MessageFormatError("fields of %d bytes, at most %d" % (sum(lengths), cls.MAX_FRAME))
+        if flags:
+            codec = codecs.by_id(flags)
+            if not codec:
+                raise MessageFormatError("unknown codec %d" % flags)
+            try:
+                payload = memoryview(codec.decompress(bytes(payload), sum(lengths)))
+            except Exception as e:
+                raise MessageFormatError("could not decompress payload: %s" % e)
 
-        STORE_REPLICA  = "Z"    # [name~uploader~part~total~data]
-        HAVE_REPLICA   = "W"    # [name~uploader~part~total]
+            if len(payload) > sum(lengths):
+                raise MessageFormatError("payload inflates past its %d bytes of fields" % sum(lengths))
 
-        REQUEST_FILE   = "S"    # [name]
-        FILE_SLICE     = "F"    # [name~part~data]
+        if len(payload) != sum(lengths):
+            raise MessageFormatError("field lengths do not add up to payload length")
+        return cls.split_fields(payload, lengths)
 
+    # Cuts payload into its fields without copying (when given a memoryview)
     @classmethod
-    def data_to_str(cls, tag, data):
-        MAX_SIZE = cls.LENGTH_SIZE
+    def split_fields(cls, payload, lengths, offset = 0):
+        fields = []
+        for length in lengths:
+            fields.append(payload[offset:offset + length])
+            offset += length
+        return fields
+
+    @staticmethod
+    def _to_bytes(field):
+        if isinstance(field, str):
+            return str.encode(field)
+        if isinstance(field, (bytes, bytearray, memoryview)):
+            return field
+        return str.encode(str(field))
+
+
+# Decodes a text field
+def text(field):
+    return bytes(field).decode()
+
 
-        if isinstance(data, list):
-            data_str = cls.DELIMITER.join(data)
-        elif isinstance(data, str):
-            data_str = data
-        else:
-            print("data_to_str only supposrt lists and strings")
-            return False
+###########################
+## Message Exceptions
+###########################
+class MessageError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
 
-        size = str(len(data_str))
-        padding = MAX_SIZE - len(size)
-        size_str = padding * "0" + size
-        
-        msg = tag + size_str + data_str
-        return msg
+class MessageFormatError(MessageError):
+    def __init__(self, msg):
+        MessageError.__init__(self, "Message format error: " + msg)
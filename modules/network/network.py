@@ -2,10 +2,13 @@ import json
 import socket
 import logging
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 from .entity import Entity
 from .node import Node
 from .networkconfig import NetworkConfig
+from . import codec as codecs
 from modules.logger.log import Log
 
 logger = None
@@ -14,28 +17,56 @@ log = None
 # _nodes:       mapping of host -> node, all nodes created since startup
 # _names:       mapping of host -> id (currently not updated when hosts disconnect)
 # _users:       mapping of id -> host (currently not updated when hosts disconnect)
+# _free_space:  mapping of id -> bytes free for replicas, from its last heartbeat
 # _seen:        all hosts encountered (theoretically ever)
 # _new:         hosts first connected to during this run
 # _connected:   hosts currently connected to
+# _dialing:     hosts a connect_to_host is dialing right now
 # _verified:    hosts verifed during this run
+# _codecs:      mapping of host -> codec chosen for its bulk payloads
+# _backoff:     mapping of host -> (failed dials in a row, time of next startup attempt)
 
 
 class Network:
     LISTEN_PORT = 8889
     TESTING_MODE = False
 
-    def __init__(self, me, test):
+    # extra connections per peer for bulk data, next to the control connection
+    DATA_CHANNELS = 2
+
+    # startup dials this many hosts at once
+    DIAL_WORKERS = 64
+
+    # a host that failed to answer is skipped by startup for
+    # BACKOFF_BASE * 2^(failures - 1) seconds, at most BACKOFF_MAX
+    BACKOFF_BASE = 5
+    BACKOFF_MAX = 600
+
+    def __init__(self, me, test, engine = None, compress = True, data_channels = DATA_CHANNELS,
+                 dial_workers = DIAL_WORKERS):
         self._me = me
         self.TESTING_MODE = test
+        self._data_channels = data_channels
+        self._dial_workers = dial_workers
+        self._backoff = {}
+
+        # codecs we advertise to peers, most preferred first
+        self._accept_codecs = codecs.available() if compress else []
+        self._codecs = {}
+
+        # asyncio engine for outgoing connections, None for plain sockets
+        self._engine = engine
 
         self._nodes = {}
         self._seen = set()
         self._new = set()
         self._connected = set()
+        self._dialing = set()
         self._verified = set()
         self._config = NetworkConfig()
 
         self._names = {}
+        self._free_space = {}
         self._users = {}
         self._users[me.id] = me.host
         self._names[me.host] = me.id
@@ -53,8 +84,11 @@ class Network:
 ## Network Outgoing Interface
 #####################################
     def connect_to_host(self, host):
-        if host in self._connected:
-            return False
+        # startup dials in parallel, so claim the host before dialing it
+        with self._lock:
+            if host in self._connected or host in self._dialing:
+                return False
+            self._dialing.add(host)
 
         self._logger.info("Network: Attempting to connect to %s" % (host))
 
@@ -64,18 +98,21 @@ class Network:
             test_port = 8825 + (self._me.port % 2)
             port = test_port if self.TESTING_MODE else self.LISTEN_PORT
 
-            conn = socket.create_connection((host, port), 1)
-            node = Node(host, port, conn)
+            conn = self._dial(host, port)
+            node = Node(host, port, conn, self._dial_data(host, port), self._engine)
+            node.set_codec(self._codecs.get(host))
 
             # send host your credentials
-            node.send_verification(self._me.id)
+            node.send_verification(self._me.id, self._accept_codecs)
 
             # add node to all relevant sets
-            self._nodes[host] = node
-            self._connected.add(host)
-            if host not in self._seen:
-                self._new.add(host)
-                self._seen.add(host)
+            with self._lock:
+                self._nodes[host] = node
+                self._connected.add(host)
+                if host not in self._seen:
+                    self._new.add(host)
+                    self._seen.add(host)
+            self._record_dial(host, True)
 
             if host in self._verified:
                 print("Connected to %s at %s" % (self._names[host], host))
@@ -84,9 +121,14 @@ class Network:
             return True
         except:
             self._logger.info("Network: Connection to %s failed" % (host))
+            self._record_dial(host, False)
             return False
+        finally:
+            with self._lock:
+                self._dialing.discard(host)
 
     def disconnect_from_host(self, host):
+        if host in self._codecs: self._codecs.pop(host)
         if host in self._connected: self._connected.remove(host)
         if host in self._verified: self._verified.remove(host)
         if host in self._nodes: self._nodes[host].close_connection()
@@ -95,11 +137,13 @@ class Network:
             self._users[id] = None
             self._names.pop(host)
 
-    def broadcast_heartbeats(self):
+    # Also counts the round in every known user's uptime, so how often
+    # each one is up builds up over time. free_space goes to every peer.
+    def broadcast_heartbeats(self, free_space = None):
         try:
             for host in self._connected:
                 if host in self._verified:
-                    if self._nodes[host].send_heartbeat():
+                    if self._nodes[host].send_heartbeat(free_space):
                         self._logger.debug("Network: Heartbeat sent to %s" % (host))
                     else:
                         self._logger.info("Network: Heartbeat to %s failed" % (host))
@@ -108,6 +152,9 @@ class Network:
             # This is from _connected changing size
             pass
 
+        ids = [id for id in list(self._users) if id != self._me.id]
+        self._config.record_uptime({id: self.user_connected(id) for id in ids})
+
 
     def broadcast_host(self, new_host):
         if new_host not in self._verified:
@@ -157,6 +204,18 @@ class Network:
             return
         self._nodes[host].send_replica(filename, id, part_num, total_parts, data)
 
+    # Tells a replica host which chunks the parts of a file have
+    def send_manifest(self, host, filename, id, total_parts, digests, coding = None):
+        if not self.connected(host):
+            return
+        self._nodes[host].send_manifest(filename, id, total_parts, digests, coding)
+
+    # Answers a manifest with the parts we don't have yet
+    def send_need_parts(self, host, filename, parts):
+        if not host in self._nodes:
+            return
+        self._nodes[host].send_need_parts(filename, parts)
+
     # Called by doofus to broadcast possession of replica to network
     def broadcast_replica(self, file_name, uploader, part_num, total_parts):
         for host in list(self._connected):
@@ -169,18 +228,30 @@ class Network:
             return
         self._nodes[host].request_file(file_name, part_num, total_parts)
 
-    def serve_file_request(self, host, file_name, part_num, total_parts, file):
-        self._nodes[host].serve_file_request(file_name, part_num, total_parts, file)
+    def serve_file_request(self, host, file_name, part_num, total_parts, file_offset, file_size, file,
+                           coding = None):
+        self._nodes[host].serve_file_request(file_name, part_num, total_parts, file_offset, file_size, file, coding)
+
+    # Serves a part straight from disk: count bytes of the file at path from offset
+    def serve_file_range(self, host, file_name, part_num, total_parts, file_offset, file_size, path, offset, count,
+                         coding = None):
+        self._nodes[host].serve_file_range(file_name, part_num, total_parts, file_offset, file_size,
+                                           path, offset, count, coding)
         
     def send_dfs_info(self, host, dfs):
         if not host in self._nodes:
             return
 
         node = self._nodes[host]
-        print(dfs)
         dfs_json_str = json.dumps(dfs)
         node.send_dfs_info(dfs_json_str)
 
+    def send_dfs_digest(self, host, digest):
+        if not host in self._nodes:
+            return
+
+        self._nodes[host].send_dfs_digest(json.dumps(digest))
+
     def delete_file(self, file_name):
         for host in list(self._connected):
             self._nodes[host].delete_file(file_name)
@@ -195,6 +266,21 @@ class Network:
         print(self._connected)
         print(self._verified)
         print(self._users)
+        self.display_compression()
+
+    def display_compression(self):
+        for host in list(self._connected):
+            node = self._nodes[host]
+            name, raw, wire = node.compression_stats()
+            print("%s     %s: %d bytes sent as %d, %d saved, %d data channels" %
+                  (host, name if name else "no compression", raw, wire, raw - wire, node.data_channels()))
+
+    def display_flush_stats(self):
+        print("network conf %d changes in %d disk writes, %d coalesced" % self._config.flush_stats())
+
+    # Returns once the network config is on disk
+    def flush(self):
+        self._config.flush()
 
     def display_users(self):
         online = []
@@ -223,13 +309,20 @@ class Network:
         print("%s     %s" % (user, host))
             
 
+    # Dials every known host that isn't connected or backing off, up to
+    # DIAL_WORKERS at a time and most recently reachable first, so a config
+    # full of offline machines costs about one timeout instead of one each.
     def startup(self):
-        try:
-            for host in self._seen:
-                self.connect_to_host(host)
-        except RuntimeError:
-            # This is from hosts being added to _seen
-            pass
+        now = time.time()
+        with self._lock:
+            hosts = [host for host in self._seen
+                     if host not in self._connected and self._backoff.get(host, (0, 0))[1] <= now]
+        hosts.sort(key=self._config.last_seen, reverse=True)
+
+        if not hosts:
+            return
+        with ThreadPoolExecutor(max_workers=min(self._dial_workers, len(hosts))) as pool:
+            list(pool.map(self.connect_to_host, hosts))
 
     def verify_host(self, host, id):
         verified = id in self._users and self._users[id] == None
@@ -263,17 +356,35 @@ class Network:
 
         return verified
 
+    # Picks the codec for host's bulk payloads from the list it advertised
+    def negotiate_codec(self, host, names):
+        codec = codecs.choose(names)
+        self._codecs[host] = codec
+        if host in self._nodes:
+            self._nodes[host].set_codec(codec)
+        self._logger.info("Network: compressing for %s with %s" % (host, codec.name if codec else "nothing"))
+
     def add_users(self, ids):
         for id in ids:
             if not id in self._users:
                 self._users[id] = None
                 self._config.store_id(id)
 
-    def record_heartbeat(self, host):
+    def record_heartbeat(self, host, free_space = None):
         if not host in self._nodes:
             self._logger.error("can't recieve heartbeat from nonexistent node")
             return
         self._nodes[host].record_heartbeat()
+        if free_space is not None and host in self._names:
+            self._free_space[self._names[host]] = free_space
+
+    # Share of heartbeat rounds user id was up for, None if unknown
+    def availability(self, id):
+        return self._config.availability(id)
+
+    # Bytes user id last said it has free for replicas, None if unknown
+    def free_space(self, id):
+        return self._free_space.get(id)
 
     def connected(self, host):
         if not host in self._connected: return False
@@ -319,6 +430,39 @@ class Network:
 ## Helper Functions
 #####################################
 
+    # timeout bounds connecting only. Sends block for as long as the peer
+    # takes to read, since a part to a slow peer can take far longer
+    def _dial(self, host, port, timeout = 1):
+        if self._engine:
+            return self._engine.connect(host, port, timeout)
+        conn = socket.create_connection((host, port), timeout)
+        conn.settimeout(None)
+        return conn
+
+    # Opens the bulk data connections for a peer. Heartbeats and other control
+    # frames keep the first connection to themselves. A peer we can only
+    # reach once still works, with bulk data sharing the control connection.
+    def _dial_data(self, host, port):
+        conns = []
+        for i in range(self._data_channels):
+            try:
+                conns.append(self._dial(host, port))
+            except Exception:
+                self._logger.info("Network: Data connection %d to %s failed" % (i + 1, host))
+                break
+        return conns
+
+    # Tracks dial outcomes for startup's backoff and ordering
+    def _record_dial(self, host, reached):
+        if reached:
+            self._backoff.pop(host, None)
+            self._config.record_seen(host)
+            return
+
+        failures = self._backoff.get(host, (0, 0))[0] + 1
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** (failures - 1))
+        self._backoff[host] = (failures, time.time() + delay)
+
     def _load_from_config(self):
         for host in self._config.hosts():
             # don't add self (for running local test)
@@ -1,11 +1,30 @@
 import json
+import os
+import time
+from threading import Lock
+from modules.flusher.flusher import Flusher
 
+# Nodes entries look like {"host": host, "last_seen": timestamp}; last_seen
+# is missing for hosts never reached since it was added.
+#
+# Uptime maps a user id to [rounds up, rounds], counted once per heartbeat
+# round while we are running. Both decay by UPTIME_DECAY a round so that
+# what a peer did lately counts more than what it did months ago.
+#
+# Changes are written by a Flusher thread, so a burst of dials or joins
+# costs one write and nobody waits on the disk. _lock guards _json.
 class NetworkConfig:
 
     FILEPATH = 'data/config_network.json'
 
+    # seconds a change may wait before it is written
+    FLUSH_INTERVAL = 1
 
-    def __init__(self):
+    # rounds are 5 seconds apart, so old rounds count half after a week
+    UPTIME_DECAY = 0.5 ** (1 / (7 * 24 * 720))
+
+    def __init__(self, flush_interval = FLUSH_INTERVAL):
+        self._lock = Lock()
         self._json = {}
         self._json["Nodes"] = []
         self._json["Identities"] = []
@@ -15,6 +34,18 @@ class NetworkConfig:
                 self._json = json.load(file)
         except FileNotFoundError:
             self._write_to_file()
+        self._json.setdefault("Uptime", {})
+
+        self._flusher = Flusher(self._write_to_file, flush_interval)
+
+    # Returns once every change so far is on disk
+    def flush(self):
+        self._flusher.flush()
+
+    # (changes, disk writes, writes saved by coalescing)
+    def flush_stats(self):
+        changes, writes, errors = self._flusher.stats()
+        return changes, writes, self._flusher.coalesced()
 
     def hosts(self):
         return [node["host"] for node in  self._json["Nodes"]]
@@ -23,24 +54,67 @@ class NetworkConfig:
         return [id for id in self._json["Identities"]]
                 
     def store_host(self, host):
-        self._json["Nodes"].append({"host":host})
-        self._write_to_file()
+        with self._lock:
+            if self._node(host):
+                return
+            self._json["Nodes"].append({"host":host, "last_seen":time.time()})
+        self._flusher.mark_dirty()
+
+    # Remembers that host was reachable just now
+    def record_seen(self, host):
+        with self._lock:
+            node = self._node(host)
+            if not node:
+                return
+            node["last_seen"] = time.time()
+        self._flusher.mark_dirty()
+
+    # When host was last reachable, 0 if never
+    def last_seen(self, host):
+        node = self._node(host)
+        return node.get("last_seen", 0) if node else 0
+
+    # Counts a heartbeat round: up maps user ids to whether they were up
+    def record_uptime(self, up):
+        with self._lock:
+            uptime = self._json["Uptime"]
+            for id in up:
+                rounds_up, rounds = uptime.get(id, [0, 0])
+                uptime[id] = [rounds_up * self.UPTIME_DECAY + (1 if up[id] else 0),
+                              rounds * self.UPTIME_DECAY + 1]
+        self._flusher.mark_dirty()
+
+    # Share of rounds id was up for, None if it has never been counted
+    def availability(self, id):
+        with self._lock:
+            rounds_up, rounds = self._json["Uptime"].get(id, [0, 0])
+        return rounds_up / rounds if rounds else None
+
+    def _node(self, host):
+        for node in self._json["Nodes"]:
+            if node["host"] == host:
+                return node
+        return None
         
 
     def store_id(self, id):
-        self._json["Identities"].append(id)
-        self._write_to_file()
+        with self._lock:
+            self._json["Identities"].append(id)
+        self._flusher.mark_dirty()
         
         print("Added id %s to network config file" % (id))
 
 
+    # Writes a temp file and swaps it in, so a crash mid write leaves the
+    # old config. Errors go to the flusher, which keeps the change dirty
+    # and retries
     def _write_to_file(self):
-        try:
-            # Write back to the file.
-            with open(self.FILEPATH, 'w+') as file:
-                json.dump(self._json, file)
-        except Exception as e:
-            print("Failed to write network config file to disc. Exception: " + str(e))
-
-
-        
+        # Snapshot under the lock, write outside it
+        with self._lock:
+            data = json.dumps(self._json)
+        temp_name = self.FILEPATH + ".tmp"
+        with open(temp_name, 'w') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_name, self.FILEPATH)
@@ -1,33 +1,76 @@
 import time
+import threading
 from threading import Lock # _lock
 from .message import Message
+from .sendqueue import SendQueue
 
 # This class will represent other nodes in the system
 # Soft state:
 #   _host: ip address of connection
 #   _port: port of connection
-#   _conn: socket object for connection
+#   _conn: socket object for the control connection
+#   _data_conns: extra connections that carry only bulk frames
 #   _last_heartbeat: timestamp of last-received heartbeat from node
-#   _lock: Thread safety for message transmission
+#   _lock: Thread safety for closing the connections and for the counters
+#   _queue: outbound frames, drained by the writers
+#   _writers: one thread per connection doing all the sending on it (none
+#             under the asyncio engine, whose event loop does the sending)
+#   _codec: codec negotiated for bulk payloads, None to send them raw
+#   _bytes_raw: bulk payload bytes before compression
+#   _bytes_wire: bulk payload bytes actually sent
 class Node:
 
     # Current heartrate is 0.2/sec, so this gives us time to miss
     # at most 1 heartbeat before we consider it dead.
     TIMEOUT = 12
 
-    def __init__(self, host, port, socket):
+    # Control frames always go out on socket. Bulk frames are striped over
+    # data_sockets, one writer each, or share socket when there are none.
+    # With an asyncio engine the sockets are its StreamConnections and the
+    # engine drains the queue from its loop instead of threads.
+    def __init__(self, host, port, socket, data_sockets = [], engine = None):
         self._host = host
         self._port = port
         self._conn = socket
+        self._data_conns = list(data_sockets)
 
         self._id = None
         self._last_heartbeat = time.time()
 
         self._lock = Lock()
 
+        self._codec = None
+        self._bytes_raw = 0
+        self._bytes_wire = 0
+
+        self._queue = SendQueue()
+        self._writers = []
+        lanes = [(socket, True, not self._data_conns)] + [(conn, False, True) for conn in self._data_conns]
+        for conn, control, bulk in lanes:
+            if engine:
+                engine.drain(self._queue, conn, control, bulk, lambda err: self.close_connection())
+                continue
+            writer = threading.Thread(target=self._write_loop, args=(conn, control, bulk), daemon=True)
+            self._writers.append(writer)
+            writer.start()
+
+    def data_channels(self):
+        return len(self._data_conns)
+
     def host(self):
         return self._host
 
+    def set_codec(self, codec):
+        self._codec = codec
+
+    # (codec name, bulk bytes before compression, bulk bytes sent)
+    def compression_stats(self):
+        name = self._codec.name if self._codec else None
+        return name, self._bytes_raw, self._bytes_wire
+
+    def bytes_saved(self):
+        return self._bytes_raw - self._bytes_wire
+
     # Not currently useful
     def record_heartbeat(self):
         self._last_heartbeat = time.time()
@@ -36,13 +79,21 @@ class Node:
     def is_alive(self):
         return self._conn and (time.time() - self._last_heartbeat < self.TIMEOUT)
 
+    # (control frames, bulk frames, bulk bytes) waiting to be sent
+    def backlog(self):
+        return self._queue.backlog()
+
     # Closes socket.
     def close_connection(self):
+        self._queue.close()
         self._lock.acquire()
         try:
             if self._conn:
                 self._conn.close()
                 self._conn = None
+            for conn in self._data_conns:
+                conn.close()
+            self._data_conns = []
         except Exception as e:
             # if the logger is ever passed in, put this info in there
             pass
@@ -52,17 +103,21 @@ class Node:
     def send_poke(self):
         return self._send_message(Message.Tags.POKE, "poke")
     
-    # Sends single byte message as heartbeat to host. Primarily used to test
+    # Sends a small message as heartbeat to host. Primarily used to test
     # the connection; if it doesn't go through, we assume the host is down.
-    def send_heartbeat(self):
-        return self._send_message(Message.Tags.HEARTBEAT, "hi")
+    # It carries the bytes we have free for replicas, if we know.
+    def send_heartbeat(self, free_space = None):
+        return self._send_message(Message.Tags.HEARTBEAT, "hi" if free_space is None else str(free_space))
 
     def send_dfs_info(self, dfs_json_str):
         return self._send_message(Message.Tags.DFS_INFO, dfs_json_str)
 
-    # Identifies self to host
-    def send_verification(self, id):
-        return self._send_message(Message.Tags.IDENTITY, id)
+    def send_dfs_digest(self, digest_json_str):
+        return self._send_message(Message.Tags.DFS_DIGEST, digest_json_str)
+
+    # Identifies self to host, listing the codecs we can receive
+    def send_verification(self, id, codecs):
+        return self._send_message(Message.Tags.IDENTITY, [id, ",".join(codecs)])
 
     # Sends new node information to host
     def send_host_joined(self, host):
@@ -74,40 +129,107 @@ class Node:
     def add_file(self, file_name, my_id):
         return self._send_message(Message.Tags.UPLOAD_FILE, [file_name, my_id])
 
+    # Lists the chunks of a file about to be replicated, so the host can
+    # say which parts it already has
+    def send_manifest(self, file_name, uploader, total_parts, digests, coding = None):
+        return self._send_message(Message.Tags.MANIFEST, [file_name, uploader, total_parts, b"".join(digests),
+                                                          _coding_field(coding)], True)
+
+    def send_need_parts(self, file_name, parts):
+        return self._send_message(Message.Tags.NEED_PARTS, [file_name, ",".join(str(part) for part in parts)])
+
     def replica_alert(self, file_name, uploader, part_num, total_parts):
         return self._send_message(Message.Tags.HAVE_REPLICA, [file_name, uploader, part_num, total_parts])
 
     def request_file(self, file_name, part_num, total_parts):
         return self._send_message(Message.Tags.REQUEST_FILE, [file_name, part_num, total_parts])
 
-    def serve_file_request(self, file_name, part_num, total_parts, file):
-        return self._send_message(Message.Tags.FILE_SLICE, [file_name, part_num, total_parts, file])
+    # The part goes at file_offset in a file of file_size bytes. coding is
+    # (shard index, k, m) when the part is a shard of an erasure coded file
+    def serve_file_request(self, file_name, part_num, total_parts, file_offset, file_size, file, coding = None):
+        return self._send_message(Message.Tags.FILE_SLICE, [file_name, part_num, total_parts, str(file_offset),
+                                                            str(file_size), _coding_field(coding), file], True)
+
+    # Serves a part that sits on disk as raw bytes: the frame header goes out
+    # first, then the kernel copies count bytes at offset straight from the
+    # file at path to the socket. If the peer takes compressed slices the
+    # range is read and compressed instead, since on a thin uplink bytes
+    # cost more than copies.
+    def serve_file_range(self, file_name, part_num, total_parts, file_offset, file_size, path, offset, count,
+                         coding = None):
+        if self._codec:
+            with open(path, "rb") as file:
+                file.seek(offset)
+                data = file.read(count)
+            return self.serve_file_request(file_name, part_num, total_parts, file_offset, file_size, data, coding)
+
+        head = Message.pack_head(Message.Tags.FILE_SLICE, [file_name, part_num, total_parts, str(file_offset),
+                                                           str(file_size), _coding_field(coding)], count)
+        return self._queue.put(([head], (path, offset, count)), len(head) + count, True)
 
     def delete_file(self, file_name):
         return self._send_message(Message.Tags.REMOVE_FILE, [file_name])
 
-    
-    # Since network.py will theoretically be sending heartbeats and other messages on different
-    # threads (but on the same port), it's important to lock around the
-    def _send_message(self, tag, data):
-        self._lock.acquire()
-        try:
-            msg = Message.data_to_str(tag, data)
-            self._conn.send(str.encode(msg))
-        except Exception as err:
-            print(err)
-            self._lock.release()
-            return False
-
-        self._lock.release()
-        return True
-
-
     def send_replica(self, file_name, id, part_num, total_parts, data):
-        
-        print("Sending " + file_name +  " to " + self._host + "...")
-
-        self._send_message(Message.Tags.STORE_REPLICA, [file_name, id, "1", "1", data])
-
-        print("Finished sending %s to %s" % (file_name, self._host))
-
+        return self._send_message(Message.Tags.STORE_REPLICA, [file_name, id, part_num, total_parts, data], True)
+
+    # Queues a frame for the writer and returns without waiting for the send.
+    # Bulk payloads (replicas and slices) are compressed with the negotiated
+    # codec here, on the producer's thread, and wait for room in the queue.
+    # Returns False once the connection is gone.
+    def _send_message(self, tag, data, bulk = False):
+        buffers = Message.pack(tag, data, self._codec if bulk else None)
+        size = sum(len(buf) for buf in buffers)
+
+        if bulk:
+            raw, wire = Message.payload_sizes(buffers)
+            with self._lock:
+                self._bytes_raw += raw
+                self._bytes_wire += wire
+
+        return self._queue.put((buffers, None), size, bulk)
+
+    # Writer thread for one connection: the only thread that sends on conn,
+    # so frames never interleave. It takes frames from the lanes it serves.
+    # A failed send means the peer is gone.
+    def _write_loop(self, conn, control, bulk):
+        while True:
+            item = self._queue.get(control, bulk)
+            if item is None:
+                return
+
+            buffers, range = item
+            try:
+                for buf in buffers:
+                    conn.sendall(buf)
+                if range:
+                    path, offset, count = range
+                    with open(path, "rb") as file:
+                        self._send_range(conn, file, offset, count)
+            except Exception as err:
+                if not self._queue.closed():
+                    print(err)
+                    self.close_connection()
+                return
+
+    # Sends count bytes of file from offset. Uses sendfile on real sockets
+    # and falls back to reading the range for connections that can't
+    def _send_range(self, conn, file, offset, count):
+        if hasattr(conn, "sendfile"):
+            sent = conn.sendfile(file, offset, count)
+            if sent != count:
+                raise OSError("file ended %d bytes into a %d byte range" % (sent, count))
+            return
+
+        file.seek(offset)
+        while count:
+            data = file.read(min(count, Message.SMALL_FRAME))
+            if not data:
+                raise OSError("file ended before the end of the range")
+            conn.sendall(data)
+            count -= len(data)
+
+
+# The coding field of MANIFEST and FILE_SLICE frames
+def _coding_field(coding):
+    return ",".join(str(n) for n in coding) if coding else ""
@@ -0,0 +1,109 @@
+from collections import deque
+from threading import Condition
+
+# Bounded outbound queue for one peer, drained by that peer's writer thread
+# (or, under the asyncio engine, from the event loop with poll and watch).
+#
+# Control frames (heartbeats, handshakes, acks, requests) go in their own
+# lane and are always taken before bulk data, so they never wait behind a
+# replica. Bulk producers block once the queued bulk bytes reach the limit,
+# which pushes back on whoever is reading files off disk faster than the
+# link drains them. Control frames are small and never block.
+#
+# Soft state:
+#   _limit: max queued bulk bytes before put blocks
+#   _control: control lane, (item, size) pairs
+#   _bulk: bulk lane, (item, size) pairs
+#   _bulk_bytes: bytes waiting in the bulk lane
+#   _closed: set once the peer is gone; puts fail and get returns None
+#   _watchers: callbacks run after every put and on close
+#   _cond: guards all of the above
+class SendQueue:
+
+    LIMIT = 8 * 1024 * 1024
+
+    def __init__(self, limit = LIMIT):
+        self._limit = limit
+        self._control = deque()
+        self._bulk = deque()
+        self._bulk_bytes = 0
+        self._closed = False
+        self._watchers = []
+        self._cond = Condition()
+
+    # Queues item. Bulk items wait for room. Returns False if the queue is closed
+    def put(self, item, size, bulk = False):
+        with self._cond:
+            if bulk:
+                # an item bigger than the limit still goes through on an empty lane
+                while not self._closed and self._bulk_bytes and self._bulk_bytes + size > self._limit:
+                    self._cond.wait()
+            if self._closed:
+                return False
+
+            if bulk:
+                self._bulk.append((item, size))
+                self._bulk_bytes += size
+            else:
+                self._control.append((item, size))
+            self._cond.notify_all()
+            self._wake()
+            return True
+
+    # Takes the next item from the lanes asked for, control lane first.
+    # Blocks until there is one; returns None once the queue is closed
+    def get(self, control = True, bulk = True):
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                item = self._take(control, bulk)
+                if item is not None:
+                    return item
+                self._cond.wait()
+
+    # Like get, but returns None instead of waiting when nothing is queued
+    def poll(self, control = True, bulk = True):
+        with self._cond:
+            if self._closed:
+                return None
+            return self._take(control, bulk)
+
+    # Runs callback (under the queue's lock, so it must not block) whenever
+    # an item is queued and when the queue closes
+    def watch(self, callback):
+        with self._cond:
+            self._watchers.append(callback)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._control.clear()
+            self._bulk.clear()
+            self._bulk_bytes = 0
+            self._cond.notify_all()
+            self._wake()
+
+    def closed(self):
+        return self._closed
+
+    # (control items, bulk items, bulk bytes) waiting
+    def backlog(self):
+        with self._cond:
+            return len(self._control), len(self._bulk), self._bulk_bytes
+
+    # Pops the next item from the lanes asked for, None if they are empty.
+    # Caller holds _cond
+    def _take(self, control, bulk):
+        if control and self._control:
+            return self._control.popleft()[0]
+        if bulk and self._bulk:
+            item, size = self._bulk.popleft()
+            self._bulk_bytes -= size
+            self._cond.notify_all()
+            return item
+        return None
+
+    def _wake(self):
+        for callback in self._watchers:
+            callback()
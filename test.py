@@ -51,6 +51,60 @@ def _test_dfs():
         except dfs.DFSAddFileError:
             pass
 
+        # Digests: two tables with the same files agree, a change shows up
+        # in exactly one bucket and only that bucket's files are exchanged
+        other = dfs.DFS("test_other_dfs.json")
+        other.clear_files()
+        other.add_file("newfile", "userA")
+        if other.diff_digest(file_system.digest()):
+            print(prefix + "ERROR: equal file tables have different digests.")
+            return 0
+        other.add_replicas("newfile", ["userB"])
+        other.add_file("otherfile", "userB")
+        buckets = other.diff_digest(file_system.digest())
+        delta = other.files_in_buckets(buckets)
+        if len(delta) != 2 or len(buckets) > 2:
+            print(prefix + "ERROR: digest delta has the wrong files.")
+            return 0
+
+        # Snapshots: a view taken before a change doesn't see it
+        before = other.snapshot()
+        other.add_replicas("newfile", ["userC"])
+        other.delete_file("otherfile")
+        if len(before) != 2 or before.files()[0]["replicas"] != ["userB"]:
+            print(prefix + "ERROR: snapshot changed after it was taken.")
+            return 0
+        if other.list_files()[0]["replicas"] != ["userB", "userC"] or len(other.snapshot()) != 1:
+            print(prefix + "ERROR: new snapshot missing a change.")
+            return 0
+
+        # a snapshot sorts its listing once, and a change in place keeps the
+        # file where it was added
+        for name in ["b", "c"]:
+            other.add_file(name, "userA")
+        other.add_replicas("newfile", ["userD"])
+        if other.list_files_ref() is not other.list_files_ref():
+            print(prefix + "ERROR: snapshot listing was not cached.")
+            return 0
+        if [f["filename"] for f in other.list_files()] != ["newfile", "b", "c"]:
+            print(prefix + "ERROR: listing lost insertion order.")
+            return 0
+
+        # Journal mode: changes since the last snapshot come back from the
+        # journal, and a torn record at its end is ignored
+        journaled = dfs.DFS("test_journal_dfs.json", journal = True, checkpoint_period = 4)
+        journaled.clear_files()
+        for name in ["a", "b", "c", "d"]:
+            journaled.add_file(name, "userA")
+        journaled.add_replicas("d", ["userB"])
+        journaled.delete_file("a")
+        with open("test_journal_dfs.json.journal", "a") as journal:
+            journal.write('{"op" : "add_fi')
+        restored = dfs.DFS("test_journal_dfs.json", journal = True)
+        if restored.digest() != journaled.digest() or restored.check_file("a", "userA"):
+            print(prefix + "ERROR: journal replay did not restore the file table.")
+            return 0
+
     # All unintentional errors caught here
     except Exception as e:
         print(prefix + str(e))
@@ -74,22 +128,1154 @@ def _test_Msg_abstraction():
         traceback.print_tb(e.__traceback__)
         return 0
 
-def _test_dfs_manager():
-    prefix = "DFSManager: ".ljust(15)
+def _test_message():
+    prefix = "Message: ".ljust(15)
     try:
-        import modules.dfs.dfsmanager as manager
+        import socket
+        import threading
+        import os
+        from modules.network.message import Message, text
+        from modules.network.framereader import FrameReader
+
+        a, b = socket.socketpair()
+        reader = FrameReader(b, 16)
+
+        # delimiter characters and binary data must survive, large frames in one piece
+        big = bytes(range(256)) * 40000
+        frames = [(Message.Tags.HEARTBEAT, "hi"),
+                  (Message.Tags.STORE_REPLICA, ["a~b.txt", "userA", "1", "1", big]),
+                  (Message.Tags.USER_INFO, ["x", "", "y~z"])]
+
+        def send():
+            for tag, data in frames:
+                for buf in Message.pack(tag, data):
+                    a.sendall(buf)
+            a.close()
+        threading.Thread(target=send).start()
+
+        for tag, data in frames:
+            got_tag, fields = reader.next_frame()
+            data = data if isinstance(data, list) else [data]
+            if got_tag != tag or len(fields) != len(data):
+                print(prefix + "ERROR: wrong tag or field count for %s." % tag)
+                return 0
+            for field, expected in zip(fields, data):
+                expected = expected if isinstance(expected, bytes) else str.encode(expected)
+                if bytes(field) != expected:
+                    print(prefix + "ERROR: field corrupted in %s frame." % tag)
+                    return 0
+            if tag == Message.Tags.STORE_REPLICA:
+                held = fields
+
+        if reader.next_frame() is not None:
+            print(prefix + "ERROR: read past end of stream.")
+            return 0
+        b.close()
+
+        # the buffer shrinks back once the big frame is handed out, and the
+        # big frame's fields outlive it
+        if len(reader._buf) != 16 or bytes(held[4]) != big:
+            print(prefix + "ERROR: buffer kept its size after a big frame.")
+            return 0
+
+        # short reads: deliver a stream of small frames one byte at a time
+        class Trickle:
+            def __init__(self, data):
+                self._data = data
+            def recv_into(self, view):
+                if not self._data:
+                    return 0
+                view[0] = self._data[0]
+                self._data = self._data[1:]
+                return 1
+
+        # a part served from disk with sendfile reads back as a normal slice
+        import tempfile
+        from modules.network.node import Node
+        a, b = socket.socketpair()
+        file = tempfile.NamedTemporaryFile()
+        file.write(big)
+        file.flush()
+        Node("peer", 0, a).serve_file_range("f", "2", "3", 5000, 900000, file.name, 1000, 300000)
+        tag, fields = FrameReader(b).next_frame()
+        file.close()
+        if tag != Message.Tags.FILE_SLICE or bytes(fields[6]) != big[1000:301000] or text(fields[3]) != "5000":
+            print(prefix + "ERROR: sendfile slice corrupted.")
+            return 0
+        a.close()
+        b.close()
+
+        # compressed frames come back identical; tiny or incompressible ones go raw
+        from modules.network import codec
+        text_data = b"timestamp,level,message\n" * 10000
+        for name in codec.available():
+            frame = Message.to_bytes(Message.Tags.FILE_SLICE, ["f", "1", "1", text_data], codec.choose([name]))
+            if len(frame) >= len(text_data):
+                print(prefix + "ERROR: %s did not shrink a compressible payload." % name)
+                return 0
+            tag, fields = FrameReader(Trickle(frame)).next_frame()
+            if bytes(fields[3]) != text_data or text(fields[0]) != "f":
+                print(prefix + "ERROR: %s frame corrupted." % name)
+                return 0
+        zlib_codec = codec.choose(["zlib"])
+        for data in [b"x" * 100, os.urandom(100000)]:
+            if Message.pack(Message.Tags.FILE_SLICE, data, zlib_codec)[0][2] != 0:
+                print(prefix + "ERROR: compressed a payload that should have gone raw.")
+                return 0
+
+        stream = b"".join(Message.to_bytes(Message.Tags.HOST_JOINED, "host%d" % i) for i in range(50))
+        reader = FrameReader(Trickle(stream), 8)
+        hosts = [text(fields[0]) for tag, fields in reader.frames()]
+        if hosts != ["host%d" % i for i in range(50)]:
+            print(prefix + "ERROR: frames lost or reordered across short reads.")
+            return 0
+
+        # a header claiming a huge payload is refused before any allocation
+        from modules.network.message import MessageFormatError
+        header = Message.HEADER.pack(Message.VERSION, b"F", 0, 1, 2 ** 62) + Message.FIELD_LENGTH.pack(2 ** 62)
+        try:
+            FrameReader(Trickle(header)).next_frame()
+            print(prefix + "ERROR: accepted a frame larger than MAX_FRAME.")
+            return 0
+        except MessageFormatError:
+            pass
+
+        # a small compressed payload that inflates past its declared fields
+        # is refused, for every codec
+        for name in codec.available():
+            bomb = codec.choose([name]).compress(bytes(64 * 1024 * 1024))
+            if len(codec.choose([name]).decompress(bomb, 1024)) != 1025:
+                print(prefix + "ERROR: %s inflated past its limit." % name)
+                return 0
+            try:
+                Message.unpack_payload(codec.choose([name]).id, memoryview(bomb), [1024])
+                print(prefix + "ERROR: %s payload inflated past its fields." % name)
+                return 0
+            except MessageFormatError:
+                pass
+
+        # a socket from dialing keeps no timeout for sends: a big frame to a
+        # peer that is slow to read waits for it instead of failing
+        import time
+        from modules.network.network import Network
+        listen = socket.socket()
+        listen.bind(("127.0.0.1", 0))
+        listen.listen()
+        def slow_reader(read):
+            conn, addr = listen.accept()
+            time.sleep(1.5)
+            read(conn)
+            conn.close()
+        def drain(conn):
+            while conn.recv(1 << 20):
+                pass
+        reader_thread = threading.Thread(target=slow_reader, args=(drain,))
+        reader_thread.start()
+        dialer = Network.__new__(Network)
+        dialer._engine = None
+        conn = dialer._dial("127.0.0.1", listen.getsockname()[1])
+        conn.sendall(bytes(32 * 1024 * 1024))
+        conn.close()
+        reader_thread.join()
+
+        # the same for parts a node's writer sends, from memory and with
+        # sendfile from disk
+        got = []
+        def read_parts(conn):
+            reader = FrameReader(conn)
+            for i in range(2):
+                tag, fields = reader.next_frame()
+                got.append((tag, len(fields[-1])))
+        reader_thread = threading.Thread(target=slow_reader, args=(read_parts,))
+        reader_thread.start()
+        node = Node("peer", 0, dialer._dial("127.0.0.1", listen.getsockname()[1]))
+        part = tempfile.NamedTemporaryFile()
+        part.write(bytes(16 * 1024 * 1024))
+        part.flush()
+        node.send_replica("f", "userA", "1", "2", bytes(16 * 1024 * 1024))
+        node.serve_file_range("f", "2", "2", 0, 32 * 1024 * 1024, part.name, 0, 16 * 1024 * 1024)
+        reader_thread.join()
+        alive = node._conn is not None
+        node.close_connection()
+        part.close()
+        listen.close()
+        if not alive or got != [(Message.Tags.STORE_REPLICA, 16 * 1024 * 1024),
+                                (Message.Tags.FILE_SLICE, 16 * 1024 * 1024)]:
+            print(prefix + "ERROR: node gave up on a slow reader.")
+            return 0
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_async_engine():
+    prefix = "AsyncEngine: ".ljust(15)
+    try:
+        import socket
+        import tempfile
+        import threading
+        import time
+        from modules.network.asyncengine import AsyncEngine
+        from modules.network.message import Message, text
+        from modules.network.node import Node
+
+        # a loopback server: every frame and close is recorded per connection
+        frames = []
+        closed = []
+        done = threading.Event()
+        def on_frame(frame, host, state):
+            state.setdefault("id", object())
+            if frame is not None:
+                tag, fields = frame
+                frames.append((state["id"], tag, [bytes(field) for field in fields]))
+            return False
+        def on_close(host):
+            closed.append(host)
+            done.set()
+
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        engine = AsyncEngine(4)
+        engine.start()
+        engine.serve("127.0.0.1", port, on_frame, on_close)
+
+        # partial reads: a peer's frames arrive a few bytes at a time, split
+        # across headers, field tables and payloads
+        big = bytes(range(256)) * 4096
+        stream = b"".join([Message.to_bytes(Message.Tags.IDENTITY, "userA"),
+                           Message.to_bytes(Message.Tags.HEARTBEAT, "hi"),
+                           Message.to_bytes(Message.Tags.STORE_REPLICA, ["f", "userA", "1", "1", big])])
+        peer = socket.create_connection(("127.0.0.1", port))
+        for i in range(0, 4096, 8):
+            peer.sendall(stream[i:i + 8])
+            time.sleep(0.001)
+        peer.sendall(stream[4096:])
+
+        # a peer that disconnects is closed once, after its last frame
+        peer.close()
+        done.wait(5)
+        if [(tag, fields[-1]) for id, tag, fields in frames] != \
+                [(Message.Tags.IDENTITY, b"userA"), (Message.Tags.HEARTBEAT, b"hi"),
+                 (Message.Tags.STORE_REPLICA, big)] or len(closed) != 1:
+            print(prefix + "ERROR: frames lost or garbled across partial reads.")
+            return 0
+
+        # one that drops in the middle of a frame is closed without it
+        done.clear()
+        peer = socket.create_connection(("127.0.0.1", port))
+        peer.sendall(Message.to_bytes(Message.Tags.STORE_REPLICA, ["f", "userA", "1", "1", big])[:100])
+        peer.close()
+        done.wait(5)
+        if len(frames) != 3 or len(closed) != 2:
+            print(prefix + "ERROR: half a frame was handled.")
+            return 0
+
+        # the engine's own connections: a node's lanes are drained from the
+        # loop, bulk frames on its data connection and parts on disk going
+        # out with sendfile
+        del frames[:]
+        done.clear()
+        node = Node("127.0.0.1", port, engine.connect("127.0.0.1", port, 1),
+                    [engine.connect("127.0.0.1", port, 1)], engine)
+        part = tempfile.NamedTemporaryFile()
+        part.write(big)
+        part.flush()
+        node.send_verification("userB", ["zlib"])
+        node.send_replica("f", "userB", "1", "2", big)
+        node.serve_file_range("f", "2", "2", 0, 2 * len(big), part.name, 0, len(big))
+        node.send_heartbeat()
+        for i in range(50):
+            if len(frames) == 4:
+                break
+            time.sleep(0.1)
+        control = [tag for id, tag, fields in frames if id == frames[0][0]]
+        bulk = [(tag, fields[-1]) for id, tag, fields in frames if id != frames[0][0]]
+        if control != [Message.Tags.IDENTITY, Message.Tags.HEARTBEAT] or \
+                bulk != [(Message.Tags.STORE_REPLICA, big), (Message.Tags.FILE_SLICE, big)]:
+            print(prefix + "ERROR: drained frames went astray.")
+            return 0
+
+        node.close_connection()
+        part.close()
+        for i in range(50):
+            if len(closed) == 4:
+                break
+            time.sleep(0.1)
+        if len(closed) != 4:
+            print(prefix + "ERROR: closed connections not noticed.")
+            return 0
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_transfer():
+    prefix = "Transfer: ".ljust(15)
+    try:
+        from modules.dfs.transfer import Download, Upload
+
+        # an upload hands out parts in order, and a lost part comes back
+        # ahead of the ones not sent yet
+        upload = Upload("f", "host", 4, 4, -1)
+        upload.window.sent(upload.next_part())
+        upload.window.sent(upload.next_part())
+        upload.requeue(upload.window.expired(), 3)
+        if sorted([upload.next_part(), upload.next_part()]) != [1, 2] or upload.peek() != 3:
+            print(prefix + "ERROR: lost upload parts not sent again first.")
+            return 0
+
+        download = Download("f", ["fast", "slow"], 4, -1)
+
+        # part 1 tells us the total
+        download.sources["fast"].window.sent(download.next_part())
+        download.received(1, 8, 1000, "fast")
+        if download.total != 8:
+            print(prefix + "ERROR: total not learned from first slice.")
+            return 0
+
+        # a resumed download only asks for what it is missing
+        resumed = Download("f", ["fast"], 4, -1)
+        resumed.resume([1, 2, 4], 5)
+        if [resumed.next_part(), resumed.next_part(), resumed.next_part()] != [3, 5, None]:
+            print(prefix + "ERROR: resumed download asked for parts it has.")
+            return 0
+
+        # the fast source should end up with the bigger window
+        download.sources["fast"].record(1000000, 1)
+        download.sources["slow"].record(100000, 1)
+        download.rebalance()
+        fast = download.sources["fast"].window
+        slow = download.sources["slow"].window
+        if fast._size <= slow._size:
+            print(prefix + "ERROR: window not sized to throughput.")
+            return 0
+
+        # parts lost on the slow source are handed out again
+        part = download.next_part()
+        slow.sent(part)
+        download.reassign_stalled(3)
+        if download.next_part() != part:
+            print(prefix + "ERROR: stalled part was not reassigned.")
+            return 0
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_send_queue():
+    prefix = "SendQueue: ".ljust(15)
+    try:
+        import threading
+        import time
+        from modules.network.sendqueue import SendQueue
+
+        queue = SendQueue(100)
+        queue.put("bulk1", 60, True)
+        queue.put("control1", 10)
+
+        # the second bulk item doesn't fit, so its producer has to wait
+        blocked = threading.Thread(target=queue.put, args=("bulk2", 60, True))
+        blocked.start()
+        time.sleep(0.2)
+        if not blocked.is_alive():
+            print(prefix + "ERROR: producer was not held back at the byte limit.")
+            return 0
+
+        # control jumps the queue, and draining bulk lets the producer go
+        order = [queue.get() for i in range(3)]
+        blocked.join(1)
+        if order != ["control1", "bulk1", "bulk2"] or blocked.is_alive():
+            print(prefix + "ERROR: wrong order " + str(order))
+            return 0
+
+        # the event loop's side: poll never waits and watchers hear of puts
+        woken = []
+        queue.watch(lambda: woken.append(True))
+        if queue.poll() is not None:
+            print(prefix + "ERROR: poll returned an item from an empty queue.")
+            return 0
+        queue.put("control2", 10)
+        if not woken or queue.poll(False, True) is not None or queue.poll() != "control2":
+            print(prefix + "ERROR: poll or watch broken.")
+            return 0
+
+        queue.close()
+        if queue.get() is not None or queue.put("late", 1):
+            print(prefix + "ERROR: closed queue still in use.")
+            return 0
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_sqlite_dfs():
+    prefix = "SQLite DFS: ".ljust(15)
+    try:
+        import os
         import modules.dfs.dfs as dfs
+        from modules.dfs.sqlitedfs import SQLiteDFS
 
-        m = manager.DFSManager(None, "tester", "testmanagerdfs.json")
+        for name in ["test_sqlite_dfs.db", "test_sqlite_dfs.db-wal", "test_sqlite_dfs.db-shm"]:
+            if os.path.exists(name):
+                os.remove(name)
 
-        m.acknowledge_replica("test.txt", "tester", "127.0.0.1")
+        # the same changes give the same table and digest as the json DFS
+        memory = dfs.DFS("test_memory_dfs.json")
+        memory.clear_files()
+        store = SQLiteDFS("test_sqlite_dfs.db", flush_interval = 60)
+        for fs in [memory, store]:
+            fs.add_file("a", "userA", ["userA"])
+            fs.add_file("b", "userB")
+            fs.add_replicas("a", ["userB", "userA", "userC"])
+            fs.add_file("c", "userA")
+            fs.delete_file("b")
+        if store.list_files() != memory.list_files() or store.digest() != memory.digest():
+            print(prefix + "ERROR: sqlite table differs from the json one.")
+            return 0
+        if store.get_file("a")["replicas"] != ["userA", "userB", "userC"] or store.get_file("b"):
+            print(prefix + "ERROR: get_file returned the wrong file.")
+            return 0
 
         try:
-            m.upload_file("test.txt")
-            print(prefix + "ERROR: Was able to upload pre-existing file.")
+            store.add_file("a", "userA")
+            print(prefix + "ERROR: was able to add the same file twice.")
             return 0
         except dfs.DFSAddFileError:
             pass
+
+        # a change that fails half way leaves neither rows nor digest behind
+        before = store.digest()
+        try:
+            store.add_file("d", "userA", ["userA", object()])
+            print(prefix + "ERROR: stored a replica sqlite can't hold.")
+            return 0
+        except dfs.DFSIOError:
+            pass
+        if store.digest() != before or store.check_file("d", "userA") or store.list_files() != memory.list_files():
+            print(prefix + "ERROR: failed change was not rolled back.")
+            return 0
+
+        # changes survive a reopen once flushed; a json table is imported once
+        store.flush()
+        reopened = SQLiteDFS("test_sqlite_dfs.db", import_from = "test_memory_dfs.json")
+        if reopened.return_log() != memory.return_log() or reopened.digest() != memory.digest():
+            print(prefix + "ERROR: flushed changes lost on reopen.")
+            return 0
+        buckets = reopened.diff_digest(["0" * 16] * SQLiteDFS.BUCKETS)
+        if len(reopened.files_in_buckets(buckets)) != 2:
+            print(prefix + "ERROR: digest delta has the wrong files.")
+            return 0
+
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_dfs_stress():
+    prefix = "DFS stress: ".ljust(15)
+    try:
+        import threading
+        import modules.dfs.dfs as dfs
+
+        file_system = dfs.DFS("test_stress_dfs.json", update_period = 1000)
+        file_system.clear_files()
+        errors = []
+        done = threading.Event()
+
+        # each writer churns its own files, leaving the even ones behind
+        def write(user):
+            try:
+                for i in range(300):
+                    name = "%s-%d" % (user, i)
+                    file_system.add_file(name, user, [user])
+                    file_system.add_replicas(name, ["r1", "r2"])
+                    if i % 2:
+                        file_system.delete_file(name)
+            except Exception as e:
+                errors.append(e)
+
+        # readers must never see a half made change or trip over one
+        def read():
+            try:
+                while not done.is_set():
+                    for file in file_system.list_files():
+                        if file["replicas"][0] != file["uploader"]:
+                            errors.append(Exception("file listed with wrong replicas"))
+                    file_system.digest()
+                    for user in ["w0", "w1", "w2", "w3"]:
+                        file = file_system.get_file(user + "-0")
+                        if file and file["uploader"] != user:
+                            errors.append(Exception("get_file returned another file"))
+                        file_system.check_file(user + "-1", user)
+            except Exception as e:
+                errors.append(e)
+
+        writers = [threading.Thread(target=write, args=("w%d" % i,)) for i in range(4)]
+        readers = [threading.Thread(target=read) for i in range(8)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+
+        if errors:
+            print(prefix + "ERROR: " + str(errors[0]))
+            return 0
+
+        # the indexes agree with each other and with a table rebuilt from scratch
+        files = file_system.list_files()
+        rebuilt = dfs.DFS("test_stress2_dfs.json", update_period = 1000)
+        rebuilt.clear_files()
+        for file in files:
+            rebuilt.add_file(file["filename"], file["uploader"], file["replicas"])
+        if len(files) != 600 or rebuilt.digest() != file_system.digest():
+            print(prefix + "ERROR: file table inconsistent after concurrent changes.")
+            return 0
+
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_chunk_store():
+    prefix = "Chunk store: ".ljust(15)
+    try:
+        import io
+        import os
+        import json
+        import random
+        import base64
+        import struct
+        import tempfile
+        from modules.dfs.chunkstore import ChunkStore, Manifest
+        from modules.dfs import cdc
+
+        # an insert near the start only changes the chunks around it
+        data = random.Random(1).randbytes(3 * 1024 * 1024)
+        edited = data[:5000] + b"inserted" + data[5000:]
+        old = [chunk for offset, chunk in cdc.chunks(io.BytesIO(data), 16384, 262144)]
+        new = [chunk for offset, chunk in cdc.chunks(io.BytesIO(edited), 16384, 262144)]
+        if b"".join(new) != edited or max(len(chunk) for chunk in new) > 262144:
+            print(prefix + "ERROR: chunks don't add up to the file.")
+            return 0
+        shared = set(map(cdc.digest, old)) & set(map(cdc.digest, new))
+        if len(shared) < len(new) - 2:
+            print(prefix + "ERROR: an insert changed %d of %d chunks." % (len(new) - len(shared), len(new)))
+            return 0
+
+        # chunks are stored once by digest and read back raw
+        folder = tempfile.mkdtemp()
+        store = ChunkStore(os.path.join(folder, "chunks"))
+        for chunk in old + new:
+            store.put(cdc.digest(chunk), chunk)
+        count, stored, deduped = store.stats()
+        if count != len(set(old + new)) or stored + deduped != len(data) + len(edited):
+            print(prefix + "ERROR: duplicate chunks stored twice.")
+            return 0
+        for chunk in new:
+            name, offset, length = store.range(cdc.digest(chunk))
+            with open(name, "rb") as seg:
+                seg.seek(offset)
+                if store.get(cdc.digest(chunk)) != chunk or seg.read(length) != chunk:
+                    print(prefix + "ERROR: chunk corrupted.")
+                    return 0
+
+        # manifests survive a torn last record, and appends after it line up
+        manifest = Manifest(os.path.join(folder, "f"))
+        manifest.put(1, 2, cdc.digest(b"a"))
+        with open(os.path.join(folder, "f.man"), "ab") as file:
+            file.write(b"\0" * 7)
+        Manifest(os.path.join(folder, "f")).put(2, 2, cdc.digest(b"b"))
+        manifest = Manifest(os.path.join(folder, "f"))
+        if manifest.digest(2) != cdc.digest(b"b") or manifest.parts() != [1, 2]:
+            print(prefix + "ERROR: manifest record lost after a torn one.")
+            return 0
+
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            from modules.dfs.filewriter import Filewriter
+            os.mkdir("replicas")
+
+            # old replicas, a json file and a segment with its own index, are
+            # moved into the chunk store when first used
+            with open("replicas/old.txt.json", "w") as file:
+                json.dump([2, {"1": base64.b64encode(b"ab").decode(),
+                               "2": base64.b64encode(b"cd").decode()}, "base64"], file)
+            # replicas from before the binary protocol hold plain text, even
+            # text that happens to be valid base64
+            with open("replicas/plain.txt.json", "w") as file:
+                json.dump([2, {"1": "abcd", "2": "h\u00e9~llo"}], file)
+            with open("replicas/seg.bin.seg", "wb") as file:
+                file.write(b"xyz")
+            with open("replicas/seg.bin.idx", "wb") as file:
+                file.write(struct.pack("!IIQQ", 1, 1, 0, 3))
+            filewriter = Filewriter()
+            migrated = (os.path.exists("replicas/old.txt.json") and filewriter.has_part("old.txt", 1)
+                        and filewriter.read_from_replica("old.txt", "2") == b"cd"
+                        and filewriter.get_total("old.txt") == 2
+                        and filewriter.read_from_replica("seg.bin", "1") == b"xyz"
+                        and filewriter.read_from_replica("plain.txt", "1") == b"abcd"
+                        and filewriter.read_from_replica("plain.txt", "2") == "h\u00e9~llo".encode()
+                        and not os.path.exists("replicas/plain.txt.json")
+                        and not os.path.exists("replicas/old.txt.json")
+                        and not os.path.exists("replicas/seg.bin.seg"))
+
+            # a manifest naming chunks we hold needs no data, and a removed
+            # replica's chunks go at the next startup unless still used
+            needed = filewriter.receive_manifest("copy.txt", 3, [cdc.digest(b"cd"), cdc.digest(b"new"), cdc.digest(b"ab")])
+            adopted = needed == [2] and filewriter.read_from_replica("copy.txt", 3) == b"ab"
+            # an upload reads the parts it sends in one pass over the file
+            with open("big.bin", "wb") as file:
+                file.write(data)
+            chunks = filewriter.chunk_file("big.bin", 16384, 262144, lambda offset, data: [data])
+            streamed = b"".join(chunk for part, chunk in
+                                filewriter.read_chunks("big.bin", chunks, range(1, len(chunks) + 1))) == data
+
+            # a replica knows where its parts go, and a download writes them
+            # there in any order
+            for part, (offset, length, digest) in enumerate(chunks, 1):
+                filewriter.write_to_replica("big.bin", part, len(chunks), data[offset:offset + length])
+            os.mkdir("files")
+            for part in reversed(range(1, len(chunks) + 1)):
+                offset, size = filewriter.part_position("big.bin", part)
+                filewriter.write_to_file("dl.bin", part, len(chunks),
+                                         filewriter.read_from_replica("big.bin", part), offset, size)
+            with open("files/dl.bin", "rb") as file:
+                placed = file.read() == data
+
+            # a part that turns up again after the download finished is ignored
+            offset, size = filewriter.part_position("big.bin", 1)
+            filewriter.write_to_file("dl.bin", 1, len(chunks), filewriter.read_from_replica("big.bin", 1), offset, size)
+            placed = placed and not os.path.exists("files/dl.bin.parts") and filewriter.resume_download("dl.bin") == []
+
+            # a download cut off halfway picks up after a restart, needing
+            # only the parts it doesn't have
+            half = len(chunks) // 2
+            for part in range(1, half + 1):
+                offset, size = filewriter.part_position("big.bin", part)
+                filewriter.write_to_file("dl2.bin", part, len(chunks),
+                                         filewriter.read_from_replica("big.bin", part), offset, size)
+
+            # parts from a peer that don't fit the file are dropped unwritten
+            for part, offset in [(0, 0), (len(chunks) + 1, 0), (len(chunks), -1),
+                                 (len(chunks), size - 1)]:
+                if filewriter.write_to_file("dl2.bin", part, len(chunks), b"xy", offset, size):
+                    print(prefix + "ERROR: part %d at %d written outside the file." % (part, offset))
+                    return 0
+            restarted = Filewriter()
+            restarted.set_path("dl2.bin", "files")
+            resumed = restarted.resume_download("dl2.bin") == list(range(1, half + 1))
+            for part in range(half + 1, len(chunks) + 1):
+                offset, size = filewriter.part_position("big.bin", part)
+                restarted.write_to_file("dl2.bin", part, len(chunks),
+                                        filewriter.read_from_replica("big.bin", part), offset, size)
+            with open("files/dl2.bin", "rb") as file:
+                resumed = resumed and file.read() == data and not os.path.exists("files/dl2.bin.parts")
+            filewriter.remove("big.bin")
+
+            filewriter.remove("old.txt")
+            filewriter.remove("plain.txt")
+            filewriter.remove("seg.bin")
+            collected = Filewriter().chunk_stats()[0] == 2
+        finally:
+            os.chdir(cwd)
+        if not migrated:
+            print(prefix + "ERROR: old replica not migrated.")
+            return 0
+        if not adopted:
+            print(prefix + "ERROR: manifest did not reuse stored chunks.")
+            return 0
+        if not streamed:
+            print(prefix + "ERROR: upload parts don't add up to the file.")
+            return 0
+        if not placed:
+            print(prefix + "ERROR: downloaded parts written out of place.")
+            return 0
+        if not resumed:
+            print(prefix + "ERROR: interrupted download not resumed.")
+            return 0
+        if not collected:
+            print(prefix + "ERROR: unused chunks not collected.")
+            return 0
+
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_erasure():
+    prefix = "Erasure: ".ljust(15)
+    try:
+        import os
+        import itertools
+        import tempfile
+        from modules.dfs import erasure
+        from modules.dfs.chunkstore import Manifest
+        from modules.dfs.transfer import Download
+
+        # any k of the k + m shards rebuild the part, for any length
+        for k, m in [(1, 1), (3, 2), (4, 2)]:
+            for data in [b"", b"x", os.urandom(100001)]:
+                shards = erasure.encode(data, k, m, 7, 99)
+                for rows in itertools.combinations(range(k + m), k):
+                    if erasure.decode({row: shards[row] for row in rows}, k, m) != (7, 99, data):
+                        print(prefix + "ERROR: (%d, %d) part not rebuilt from shards %s." % (k, m, rows))
+                        return 0
+
+        # with numpy installed, its fast path gives the same shards and the
+        # same rebuilt parts as the pure python one (skipped without numpy)
+        if erasure.numpy is not None:
+            data = os.urandom(100001)
+            fast = erasure.encode(data, 4, 3, 5, 77)
+            fast_rebuilt = erasure.decode({row: fast[row] for row in [1, 4, 5, 6]}, 4, 3)
+            fast_numpy, erasure.numpy = erasure.numpy, None
+            try:
+                slow = erasure.encode(data, 4, 3, 5, 77)
+                slow_rebuilt = erasure.decode({row: slow[row] for row in [1, 4, 5, 6]}, 4, 3)
+            finally:
+                erasure.numpy = fast_numpy
+            if fast != slow or fast_rebuilt != slow_rebuilt or fast_rebuilt != (5, 77, data):
+                print(prefix + "ERROR: numpy and pure python GF(256) paths disagree.")
+                return 0
+
+        # storage is (k + m) / k of the part, not k + m copies
+        shards = erasure.encode(os.urandom(400000), 4, 2, 0, 400000)
+        if sum(len(shard) for shard in shards) > 600000 + 6 * erasure.SHARD.size:
+            print(prefix + "ERROR: shards take more room than they should.")
+            return 0
+
+        # a replica remembers which shard it is
+        base = os.path.join(tempfile.mkdtemp(), "f")
+        Manifest(base).set_coding(3, (2, 4, 2))
+        manifest = Manifest(base)
+        if manifest.coding() != (2, 4, 2) or manifest.parts():
+            print(prefix + "ERROR: shard coding not kept in the manifest.")
+            return 0
+
+        # a coded part is asked of k different hosts at once, and is only
+        # complete once k have answered
+        download = Download("f", ["a", "b", "c"], 4, 10)
+        download.sources["a"].window.sent(download.next_part("a"))
+        download.set_pieces(2)
+        first = download.received(1, 2, 100, "a")
+        asked = [download.next_part("a"), download.next_part("b"), download.next_part("c")]
+        if first or asked != [2, 1, 2]:
+            print(prefix + "ERROR: coded parts not spread over hosts (%s)." % asked)
+            return 0
+        download.sources["b"].window.sent(1)
+        if not download.received(1, 2, 100, "b") or download.done():
+            print(prefix + "ERROR: coded part not complete after k shards.")
+            return 0
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_placement():
+    prefix = "Placement: ".ljust(15)
+    try:
+        from modules.dfs import placement
+
+        if abs(placement.reachable([0.9, 0.9]) - 0.99) > 1e-9 or \
+                abs(placement.reachable([0.9, 0.9, 0.9], 1) - 0.972) > 1e-9:
+            print(prefix + "ERROR: availability of a placement miscalculated.")
+            return 0
+
+        # one always-on box is enough where laptops need several
+        laptops = [("laptop%d" % i, 0.5, None) for i in range(6)]
+        peers, reachable = placement.choose(laptops + [("server", 0.999, None)], 100, placement.target(0))
+        if peers != ["server"]:
+            print(prefix + "ERROR: over-replicated to %s." % peers)
+            return 0
+        peers, reachable = placement.choose(laptops, 100, placement.target(0))
+        if len(peers) != 4 or reachable < placement.target(0):
+            print(prefix + "ERROR: %d laptops chosen for a 90%% target." % len(peers))
+            return 0
+
+        # a peer without room is passed over, and a target out of reach
+        # gets the best there is
+        peers, reachable = placement.choose([("server", 0.999, 10)] + laptops, 100, placement.target(1))
+        if "server" in peers or len(peers) != 6:
+            print(prefix + "ERROR: placed on a peer without room.")
+            return 0
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_flusher():
+    prefix = "Flusher: ".ljust(15)
+    try:
+        import json
+        import time
+        import modules.dfs.dfs as dfs
+        from modules.flusher.flusher import Flusher
+
+        # a burst of changes within the interval is one write
+        writes = []
+        flusher = Flusher(lambda: writes.append(1), 60, 1000)
+        for i in range(50):
+            flusher.mark_dirty()
+        flusher.flush()
+        if len(writes) != 1 or flusher.coalesced() != 49:
+            print(prefix + "ERROR: burst was not coalesced into one write.")
+            return 0
+
+        # the batch size forces a write without waiting out the interval
+        flusher = Flusher(lambda: writes.append(1), 60, 10)
+        for i in range(10):
+            flusher.mark_dirty()
+        flusher.close()
+        if len(writes) != 2:
+            print(prefix + "ERROR: full batch was not written.")
+            return 0
+
+        # a failed write leaves the changes pending: flush() raises, and
+        # the thread tries again on its own after the backoff
+        from modules.flusher.flusher import FlushError
+        outcomes = [False, True]
+        def write():
+            if not outcomes.pop(0):
+                raise OSError("disk full")
+            writes.append(1)
+        flusher = Flusher(write, 60, 1000)
+        flusher.RETRY_BASE = 0.2
+        flusher.mark_dirty()
+        try:
+            flusher.flush()
+            print(prefix + "ERROR: flush() hid a failed write.")
+            return 0
+        except FlushError:
+            pass
+        for i in range(20):
+            if len(writes) == 3:
+                break
+            time.sleep(0.1)
+        if len(writes) != 3 or flusher.stats() != (1, 1, 1):
+            print(prefix + "ERROR: failed write was not retried.")
+            return 0
+        flusher.close()
+
+        # the network config reaches its flusher's retry when a write
+        # fails, and a failed write leaves the old file whole
+        import os
+        import shutil
+        import tempfile
+        from modules.network.networkconfig import NetworkConfig
+        folder = tempfile.mkdtemp()
+        class Config(NetworkConfig):
+            FILEPATH = os.path.join(folder, "config_network.json")
+        config = Config(60)
+        config.store_host("10.0.0.1")
+        config.flush()
+        os.mkdir(Config.FILEPATH + ".tmp")
+        config.store_host("10.0.0.2")
+        try:
+            config.flush()
+            print(prefix + "ERROR: network config hid a failed write.")
+            return 0
+        except FlushError:
+            pass
+        with open(Config.FILEPATH) as file:
+            if [node["host"] for node in json.load(file)["Nodes"]] != ["10.0.0.1"]:
+                print(prefix + "ERROR: failed write damaged the network config.")
+                return 0
+        os.rmdir(Config.FILEPATH + ".tmp")
+        config.flush()
+        if Config(60).hosts() != ["10.0.0.1", "10.0.0.2"]:
+            print(prefix + "ERROR: network config change was lost.")
+            return 0
+        shutil.rmtree(folder)
+
+        # flush() is a barrier: after it the file holds every change
+        file_system = dfs.DFS("test_flush_dfs.json", flush_interval = 60)
+        file_system.clear_files()
+        for i in range(20):
+            file_system.add_file("file%d" % i, "userA")
+        file_system.flush()
+        with open("test_flush_dfs.json") as file:
+            if len(json.load(file)["files"]) != 20:
+                print(prefix + "ERROR: flush() returned before the table was written.")
+                return 0
+        changes, disk_writes, coalesced = file_system.flush_stats()
+        if disk_writes >= changes:
+            print(prefix + "ERROR: dfs changes were not coalesced.")
+            return 0
+
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_dfs_manager():
+    prefix = "DFSManager: ".ljust(15)
+    try:
+        import io
+        import os
+        import random
+        import time
+        import tempfile
+        import contextlib
+        import modules.dfs.dfsmanager as manager
+        from modules.dfs.filewriter import Filewriter
+
+        # one connected host, "peer", that acknowledges every part it's sent
+        class Network:
+            _connected = {"127.0.0.1"}
+            def __init__(self):
+                self.manifests = []
+                self.sent = []
+            def id(self, host):
+                return "peer"
+            def availability(self, id):
+                return None
+            def free_space(self, id):
+                return None
+            def connected(self, host):
+                return True
+            def send_manifest(self, host, filename, id, total, digests, coding = None):
+                self.manifests.append((filename, int(total)))
+            def send_replica(self, host, filename, id, part, total, data):
+                self.sent.append(int(part))
+                m.acknowledge_replica(filename, id, "peer", part)
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                os.mkdir("replicas")
+                network = Network()
+                filewriter = Filewriter()
+                reread = []
+                read_chunks = filewriter.read_chunks
+                def count_reads(filepath, chunks, parts):
+                    reread.extend(parts)
+                    return read_chunks(filepath, chunks, parts)
+                filewriter.read_chunks = count_reads
+                m = manager.DFSManager(network, "tester", filewriter, "testmanagerdfs.json", part_size = 65536)
+                with open("test.txt", "wb") as file:
+                    file.write(random.Random(1).randbytes(300000))
+
+                # uploading a file already on the DFS resumes it: the host is
+                # sent the manifest and then only the parts it says it lacks
+                m.acknowledge_replica("test.txt", "tester", "peer")
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    started = m.upload_file("test.txt")
+                    for i in range(50):
+                        if network.manifests:
+                            break
+                        time.sleep(0.1)
+
+                    # a file still uploading can't be deleted: REMOVE_FILE
+                    # could overtake its parts
+                    m.delete_file("test.txt")
+                    m.parts_needed("test.txt", "peer", [2])
+                    for i in range(50):
+                        if not m._uploads:
+                            break
+                        time.sleep(0.1)
+            finally:
+                os.chdir(cwd)
+
+        if "Still uploading test.txt" not in out.getvalue() or not m._fs.get_file("test.txt"):
+            print(prefix + "ERROR: deleted a file in the middle of its upload.")
+            return 0
+        if not started or "Resuming upload of test.txt" not in out.getvalue():
+            print(prefix + "ERROR: upload of a file already on the DFS did not resume.")
+            return 0
+        if len(network.manifests) != 1 or network.sent != [2] or m._uploads:
+            print(prefix + "ERROR: resumed upload sent %s, not just the missing part." % network.sent)
+            return 0
+
+        # the part sent is the one chunking encoded, not read a second time
+        if reread:
+            print(prefix + "ERROR: upload read parts %s of the file twice." % reread)
+            return 0
+    except Exception as e:
+        print(prefix + str(e))
+        traceback.print_tb(e.__traceback__)
+        return 0
+
+    print(prefix + "SUCCESS")
+    return 1
+
+def _test_network():
+    prefix = "Network: ".ljust(15)
+    try:
+        import os
+        import socket
+        import tempfile
+        import threading
+        import time
+        from modules.network.entity import Entity
+        from modules.network.framereader import FrameReader
+        from modules.network.message import Message
+        from modules.network.network import Network
+        from modules.network.node import Node
+        from modules.logger.log import Log
+
+        # control frames keep the control connection to themselves and bulk
+        # frames are striped over the data connections
+        ends = [socket.socketpair() for i in range(3)]
+        node = Node("peer", 0, ends[0][0], [ends[1][0], ends[2][0]])
+        got = [[] for end in ends]
+        def read(i):
+            for tag, fields in FrameReader(ends[i][1]).frames():
+                got[i].append(tag)
+        readers = [threading.Thread(target=read, args=(i,)) for i in range(3)]
+        for reader in readers:
+            reader.start()
+        node.send_heartbeat()
+        for part in range(1, 7):
+            node.send_replica("f", "userA", str(part), "6", bytes(100000))
+        node.send_heartbeat()
+        for i in range(50):
+            if sum(len(tags) for tags in got) == 8:
+                break
+            time.sleep(0.1)
+        node.close_connection()
+        for reader in readers:
+            reader.join()
+        if got[0] != [Message.Tags.HEARTBEAT] * 2 or \
+                got[1] + got[2] != [Message.Tags.STORE_REPLICA] * 6:
+            print(prefix + "ERROR: control and bulk frames not kept apart.")
+            return 0
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                os.mkdir("data")
+                os.mkdir("logs")
+                net = Network(Entity("127.0.0.1", 8826, "me"), False, data_channels = 2, dial_workers = 1)
+
+                # dials are answered by socketpairs; hosts in down don't answer
+                dials = []
+                down = set()
+                peers = []
+                def dial(host, port, timeout = 1):
+                    dials.append(host)
+                    time.sleep(0.05)
+                    if host in down:
+                        raise OSError("unreachable")
+                    a, b = socket.socketpair()
+                    peers.append(b)
+                    return a
+                net._dial = dial
+
+                # racing connects to one host dial it once
+                results = []
+                racers = [threading.Thread(target=lambda: results.append(net.connect_to_host("10.0.0.1")))
+                          for i in range(8)]
+                for racer in racers:
+                    racer.start()
+                for racer in racers:
+                    racer.join()
+                if sorted(results) != [False] * 7 + [True] or dials != ["10.0.0.1"] * 3:
+                    print(prefix + "ERROR: one host dialed by several connects.")
+                    return 0
+                if net._nodes["10.0.0.1"].data_channels() != 2:
+                    print(prefix + "ERROR: data connections not opened.")
+                    return 0
+
+                # a peer we can only reach once still gets a node, sharing
+                # its one connection
+                real_dial = dial
+                def dial_once(host, port, timeout = 1):
+                    if dials.count(host):
+                        raise OSError("refused")
+                    return real_dial(host, port, timeout)
+                net._dial = dial_once
+                if not net.connect_to_host("10.0.0.5") or net._nodes["10.0.0.5"].data_channels() != 0:
+                    print(prefix + "ERROR: no fallback when data connections fail.")
+                    return 0
+                net._dial = dial
+
+                # startup tries the most recently seen hosts first, and skips
+                # a host that failed until its backoff is up
+                del dials[:]
+                down.add("10.0.0.2")
+                for host in ["10.0.0.2", "10.0.0.3", "10.0.0.4"]:
+                    net._seen.add(host)
+                net._config.store_host("10.0.0.3")
+                time.sleep(0.01)
+                net._config.store_host("10.0.0.4")
+                net._data_channels = 0
+                net.startup()
+                if dials != ["10.0.0.4", "10.0.0.3", "10.0.0.2"]:
+                    print(prefix + "ERROR: startup dialed in order %s." % dials)
+                    return 0
+                del dials[:]
+                net.startup()
+                if dials:
+                    print(prefix + "ERROR: startup ignored the backoff of a failed host.")
+                    return 0
+
+                for host in list(net._nodes):
+                    net.disconnect_from_host(host)
+                for peer in peers:
+                    peer.close()
+                net._config.flush()
+            finally:
+                os.chdir(cwd)
+
+        # a bulk frame on a data connection that beats the control
+        # connection's IDENTITY waits for it instead of being dropped
+        import doofus
+        class Verifier:
+            def __init__(self):
+                self.ok = False
+                self.heartbeats = 0
+            def verified(self, host):
+                return self.ok
+            def connected(self, host):
+                return True
+            def record_heartbeat(self, host, free_space):
+                self.heartbeats += 1
+        doofus.network = Verifier()
+        doofus.logger = Log().get_logger()
+        threading.Timer(0.3, lambda: setattr(doofus.network, "ok", True)).start()
+        held = doofus.handle_frame((Message.Tags.HEARTBEAT, [b"1"]), "peer", {})
+        if held or doofus.network.heartbeats != 1:
+            print(prefix + "ERROR: early data frame not held for verification.")
+            return 0
+        doofus.network = None
     except Exception as e:
         print(prefix + str(e))
         traceback.print_tb(e.__traceback__)
@@ -113,6 +1299,39 @@ if __name__ == "__main__":
         if test == "dfsm":
             outcome += _test_dfs_manager()
 
+        if test == "msg":
+            outcome += _test_message()
+
+        if test == "engine":
+            outcome += _test_async_engine()
+
+        if test == "transfer":
+            outcome += _test_transfer()
+
+        if test == "queue":
+            outcome += _test_send_queue()
+
+        if test == "network":
+            outcome += _test_network()
+
+        if test == "flusher":
+            outcome += _test_flusher()
+
+        if test == "sqlite":
+            outcome += _test_sqlite_dfs()
+
+        if test == "stress":
+            outcome += _test_dfs_stress()
+
+        if test == "chunks":
+            outcome += _test_chunk_store()
+
+        if test == "erasure":
+            outcome += _test_erasure()
+
+        if test == "placement":
+            outcome += _test_placement()
+
         ## ADDITIONAL MODULES:
         #elif test == "othertestmodule":
         #	outcome += _other_test_module() 